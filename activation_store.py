@@ -0,0 +1,175 @@
+"""
+Memory-mappable activation store for pooled verb activations.
+
+Layout of a store directory:
+
+    {store_dir}/{split}/meta.parquet               # one row per example
+    {store_dir}/{split}/layer{layer}_{stream}.npy   # [n_examples, d_model]
+
+Each shard is a contiguous float16/float32 array in .npy format, so loading
+a single (split, layer, stream) is a memory map instead of a CSV/Parquet parse.
+Row i of every shard belongs to row i of the split's metadata sidecar.
+
+ExtractionCache keeps the per-row activations of interrupted or incremental
+runs in content-addressed shards; the store above is assembled from it.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+META_COLUMNS = ['language', 'sentence', 'main_verb', 'verb_index', 'tense']
+META_FILE = 'meta.parquet'
+
+
+def shard_path(store_dir, split, layer, stream):
+    return os.path.join(store_dir, split, f'layer{layer}_{stream}.npy')
+
+
+def save_metadata(store_dir, split, df):
+    os.makedirs(os.path.join(store_dir, split), exist_ok=True)
+    cols = [c for c in META_COLUMNS if c in df.columns]
+    meta = df[cols].reset_index(drop=True)
+    # repeated labels are stored once per value
+    for col in ('language', 'tense'):
+        if col in meta.columns:
+            meta[col] = meta[col].astype('category')
+    out_file = os.path.join(store_dir, split, META_FILE)
+    meta.to_parquet(out_file, index=False)
+    return out_file
+
+
+def save_activations(store_dir, split, layer, stream, emb, dtype='float16'):
+    out_file = shard_path(store_dir, split, layer, stream)
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    np.save(out_file, np.ascontiguousarray(emb, dtype=dtype))
+    return out_file
+
+
+def load_metadata(store_dir, split):
+    return pd.read_parquet(os.path.join(store_dir, split, META_FILE))
+
+
+def load_activations(store_dir, split, layer, stream, as_torch=False):
+    """
+    Return the [n_examples, d_model] activations of one shard without reading
+    them into memory. With as_torch=True a torch tensor sharing the memory map
+    is returned (copy-on-write, the file itself is never modified).
+    """
+    path = shard_path(store_dir, split, layer, stream)
+    if not as_torch:
+        return np.load(path, mmap_mode='r')
+    import torch
+    return torch.from_numpy(np.load(path, mmap_mode='c'))
+
+
+def list_shards(store_dir, split):
+    shards = []
+    for name in sorted(os.listdir(os.path.join(store_dir, split))):
+        if not (name.startswith('layer') and name.endswith('.npy')):
+            continue
+        layer, stream = name[len('layer'):-len('.npy')].split('_', 1)
+        shards.append((int(layer), stream))
+    return shards
+
+
+def import_table(path, store_dir, split, layer, stream, prefix, dtype='float16'):
+    """
+    Convert a legacy wide table (Parquet from run_model.py or CSV from
+    run_embeddings_layer.py) with `{prefix}_{k}` columns into the store.
+    """
+    if path.endswith('.parquet'):
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path, encoding='utf-8-sig')
+    if 'tense' not in df.columns and 'label' in df.columns:
+        df = df.rename(columns={'label': 'tense'})
+    emb_cols = [c for c in df.columns
+                if c.startswith(f'{prefix}_') and c[len(prefix) + 1:].isdigit()]
+    emb_cols.sort(key=lambda c: int(c[len(prefix) + 1:]))
+    save_metadata(store_dir, split, df)
+    return save_activations(store_dir, split, layer, stream,
+                            df[emb_cols].to_numpy(), dtype=dtype)
+
+
+class ExtractionCache:
+    """
+    Content-addressed cache of pooled activations that makes extraction resumable.
+
+    Every (row, output) pair is keyed by a hash of (model name, dtype, sentence,
+    verb_index, output), where an output is a hook plus pooling strategy.
+    Activations are written in fixed-size shards as soon as they are computed
+    and recorded in an append-only manifest (manifest*.jsonl), so a rerun only
+    computes rows whose keys are missing, e.g. after a killed job or when new
+    sentences or languages are appended to the input CSVs.
+    """
+
+    def __init__(self, cache_dir, model_name, dtype, shard_rows=512, store_dtype='float16',
+                 manifest_name='manifest.jsonl'):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.dtype = str(dtype)
+        self.shard_rows = shard_rows
+        self.store_dtype = store_dtype
+        # parallel workers append to their own manifest-*.jsonl; all of them are read
+        self.manifest_path = os.path.join(cache_dir, manifest_name)
+        self.index = {}
+        os.makedirs(os.path.join(cache_dir, 'shards'), exist_ok=True)
+        for name in sorted(os.listdir(cache_dir)):
+            if not (name.startswith('manifest') and name.endswith('.jsonl')):
+                continue
+            with open(os.path.join(cache_dir, name), encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a job killed while appending leaves a partial last line
+                        continue
+                    self._add(entry)
+
+    def _add(self, entry):
+        for row, key in enumerate(entry['keys']):
+            self.index[key] = (entry['shard'], row)
+
+    def row_keys(self, sentences, verb_indices, output):
+        return [
+            hashlib.sha1(json.dumps(
+                [self.model_name, self.dtype, sentence, int(verb_index), output],
+                ensure_ascii=False
+            ).encode('utf-8')).hexdigest()[:20]
+            for sentence, verb_index in zip(sentences, verb_indices)
+        ]
+
+    def missing(self, keys):
+        return [i for i, key in enumerate(keys) if key not in self.index]
+
+    def write(self, output, keys, emb):
+        shard = hashlib.sha1((output + ''.join(keys)).encode('utf-8')).hexdigest()[:20]
+        path = os.path.join(self.cache_dir, 'shards', f'{shard}.npy')
+        tmp_path = path[:-len('.npy')] + '.tmp.npy'
+        np.save(tmp_path, np.ascontiguousarray(emb, dtype=self.store_dtype))
+        os.replace(tmp_path, path)
+        # the manifest entry is only written once the shard is complete on disk
+        entry = {'shard': shard, 'output': output, 'keys': list(keys)}
+        with open(self.manifest_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._add(entry)
+
+    def gather(self, keys):
+        """Return the cached activations of `keys`, in the order of `keys`."""
+        by_shard = {}
+        for i, key in enumerate(keys):
+            shard, row = self.index[key]
+            by_shard.setdefault(shard, ([], []))
+            by_shard[shard][0].append(i)
+            by_shard[shard][1].append(row)
+        out = None
+        for shard, (dst, src) in by_shard.items():
+            emb = np.load(os.path.join(self.cache_dir, 'shards', f'{shard}.npy'), mmap_mode='r')
+            if out is None:
+                out = np.empty((len(keys), emb.shape[1]), dtype=emb.dtype)
+            out[dst] = emb[src]
+        return out
@@ -0,0 +1,106 @@
+"""
+Columnar store of causal-tracing results.
+
+Layout of a results directory:
+
+    {results_dir}/language={lang}/tense={tense}/stream={stream}/{prompt_id}.parquet
+    {results_dir}/_stats/{prompt_id}.npz
+
+Every prompt writes one Parquet file per (language, tense, stream) partition,
+with the repeated string columns dictionary-encoded, so rewriting a prompt
+replaces its rows. Next to the rows, every prompt saves the running
+mean/variance of delta_restored per (language, tense, stream, restore_layer,
+pos_class) as online_stats.GroupStats; load_aggregate merges them (Chan et
+al.), so layer-wise heatmaps are rebuilt without rereading the raw rows.
+"""
+import os
+import glob
+import numpy as np
+import pandas as pd
+
+from online_stats import GroupStats
+
+PARTITIONS = ['language', 'tense', 'stream']
+AGGREGATE_KEYS = ['language', 'tense', 'stream', 'restore_layer', 'pos_class']
+CATEGORICAL_COLUMNS = ['prompt_id', 'gold', 'pos_class']
+STATS_DIR = '_stats'
+
+
+def partition_dir(results_dir, language, tense, stream):
+    return os.path.join(results_dir, f'language={language}', f'tense={tense}', f'stream={stream}')
+
+
+def write_prompt_results(results_dir, prompt_id, rows):
+    """Write the rows of one prompt into its partitions and save its aggregate statistics; returns the partition files."""
+    df = pd.DataFrame(rows)
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    out_files = []
+    for (language, tense, stream), part in df.groupby(PARTITIONS, observed=True):
+        out_dir = partition_dir(results_dir, language, tense, stream)
+        os.makedirs(out_dir, exist_ok=True)
+        out_file = os.path.join(out_dir, f'{prompt_id}.parquet')
+        tmp_file = out_file + '.tmp'
+        part.drop(columns=PARTITIONS).to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, out_file)
+        out_files.append(out_file)
+    stats_dir = os.path.join(results_dir, STATS_DIR)
+    os.makedirs(stats_dir, exist_ok=True)
+    stats = GroupStats(dim=1)
+    keys = df[AGGREGATE_KEYS].astype(object).itertuples(index=False, name=None)
+    stats.update(df[['delta_restored']].to_numpy(), [tuple(_plain(k) for k in key) for key in keys])
+    # np.savez appends .npz to names without it
+    tmp_file = os.path.join(stats_dir, f'{prompt_id}.tmp.npz')
+    stats.save(tmp_file)
+    os.replace(tmp_file, os.path.join(stats_dir, f'{prompt_id}.npz'))
+    return out_files
+
+
+def _plain(value):
+    # numpy scalars are not JSON serializable in GroupStats.save
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def read_results(results_dir, columns=None, filters=None):
+    """
+    Read the result rows, e.g. filters=[('stream', '=', 'attention_output'),
+    ('restore_layer', '=', 16)]; only the matching partitions are opened.
+    """
+    import pyarrow.dataset as ds
+    files = glob.glob(os.path.join(results_dir, '**', '*.parquet'), recursive=True)
+    dataset = ds.dataset(files, format='parquet', partitioning='hive', partition_base_dir=results_dir)
+    expression = None
+    for name, op, value in filters or []:
+        if op == 'in':
+            term = ds.field(name).isin(value)
+        elif op == '=':
+            term = ds.field(name) == value
+        elif op == '!=':
+            term = ds.field(name) != value
+        else:
+            raise ValueError(f"Unsupported filter operator '{op}'")
+        expression = term if expression is None else expression & term
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def load_aggregate(results_dir, prompt_ids=None):
+    """Merge the per-prompt statistics (all prompts, or `prompt_ids`) into one GroupStats."""
+    stats = GroupStats(dim=1)
+    for path in sorted(glob.glob(os.path.join(results_dir, STATS_DIR, '*.npz'))):
+        name = os.path.basename(path)[:-len('.npz')]
+        if name.endswith('.tmp') or (prompt_ids is not None and name not in prompt_ids):
+            continue
+        stats.merge(GroupStats.load(path))
+    return stats
+
+
+def aggregate_table(stats):
+    """One row per (language, tense, stream, restore_layer, pos_class): count, mean, var and sem of delta_restored."""
+    records = []
+    for key, group in stats.groups.items():
+        var = group.variance()[0] if group.count > 1 else np.nan
+        records.append(dict(zip(AGGREGATE_KEYS, key), count=group.count, mean=group.mean[0],
+                            var=var, sem=np.sqrt(var / group.count)))
+    table = pd.DataFrame(records, columns=AGGREGATE_KEYS + ['count', 'mean', 'var', 'sem'])
+    return table.sort_values(AGGREGATE_KEYS).reset_index(drop=True)
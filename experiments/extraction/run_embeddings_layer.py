@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 """
-Script to extract Llama-3.1 8B embeddings for sentences at a specified hidden layer and save them as CSV, using batching for efficiency.
+Script to extract Llama-3.1 8B embeddings for sentences at one or more hidden layers (all from the
+same forward pass) and save them either to the memory-mappable activation store (default, see activation_store.py) or as CSV, using batching for efficiency.
 """
 import os
 import argparse
@@ -8,9 +9,16 @@ import pandas as pd
 import torch
 from transformers import AutoTokenizer, AutoModel
 
+from activation_store import save_activations, save_metadata
+from extraction_utils import (
+    POOLING_STRATEGIES, iter_token_batches, pool_verb_tokens, pooled_name, restore_order, truncate_hf_model,
+    verb_token_mask
+)
+from token_cache import TokenCache
+
 def parse_args():
     parser = argparse.ArgumentParser(
-        description="Extract embeddings from a specified hidden layer using Llama-3.1 8B with batching"
+        description="Extract embeddings from specified hidden layers using Llama-3.1 8B with batching"
     )
     parser.add_argument(
         "--train-csv", type=str, required=True, help="Path to the training CSV file"
@@ -27,55 +35,117 @@ def parse_args():
     parser.add_argument(
         "--model-name", type=str, default="meta-llama/Llama-3.1-8b", help="Pretrained model name or path"
     )
-    parser.add_argument(
-        "--layer-idx", type=int, required=True, help="Hidden layer index to extract embeddings from (0 = embeddings, 1 = first layer, etc.)"
+    layer_group = parser.add_mutually_exclusive_group(required=True)
+    layer_group.add_argument(
+        "--layer-idx", type=int, help="Hidden layer index to extract embeddings from (0 = embeddings, 1 = first layer, etc.)"
+    )
+    layer_group.add_argument(
+        "--layers", type=str, nargs="+", help="Hidden layer indices extracted in one pass, or 'all' for every hidden state"
     )
     parser.add_argument(
         "--out-dir", type=str, default="./results", help="Directory to save output CSVs"
     )
+    parser.add_argument(
+        "--output-format", type=str, default="store", choices=["store", "csv"],
+        help="store: .npy shards + metadata sidecar; csv: one wide hidden_k table per split"
+    )
+    parser.add_argument(
+        "--store-dtype", type=str, default="float16", choices=["float16", "float32"],
+        help="Dtype of the activation store shards"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=16, help="Maximum number of sentences per batch"
+    )
+    parser.add_argument(
+        "--max-tokens", type=int, default=None, help="Token budget per padded batch (sentences are bucketed by length)"
+    )
+    parser.add_argument(
+        "--token-cache", type=str, default=None,
+        help="Directory of token_cache.py outputs; skips tokenization in the extraction loop"
+    )
+    parser.add_argument(
+        "--pooling", type=str, nargs="+", default=["mean"], choices=list(POOLING_STRATEGIES),
+        help="Verb sub-token pooling strategies, all computed in the same pass"
+    )
     return parser.parse_args()
 
-def extract_embeddings(df, model, tokenizer, device, layer_idx, batch_size):
-    records = []
+def resolve_layers(args, total_layers):
+    if args.layer_idx is not None:
+        layers = [args.layer_idx]
+    elif args.layers == ['all']:
+        layers = list(range(total_layers + 1))
+    else:
+        layers = sorted(set(int(layer) for layer in args.layers))
+    if not all(0 <= layer <= total_layers for layer in layers):
+        raise ValueError(f"Layer indices must be in 0..{total_layers}, got {layers}")
+    return layers
+
+def extract_embeddings(df, model, tokenizer, device, layers, batch_size, pooling=('mean',), max_tokens=None,
+                       token_cache=None):
+    # `model` is truncated to the deepest requested layer, so it only computes hidden_states[:max(layers) + 1]
+    outputs = [(layer, strategy) for layer in layers for strategy in pooling]
+    embeddings = {key: [] for key in outputs}
     sentences = df['sentence'].tolist()
-    languages = df['language'].tolist()
-    verbs = df['main_verb'].tolist()
     verb_indices = df['verb_index'].tolist()
-    labels = df['tense'].tolist()
-
-    for start in range(0, len(sentences), batch_size):
-        end = start + batch_size
-        batch_sent = sentences[start:end]
-        batch_indices = verb_indices[start:end]
-        tokenized = tokenizer(
-            [sent.split() for sent in batch_sent],
-            is_split_into_words=True,
-            return_tensors='pt',
-            padding=True,
-            truncation=True
-        ).to(device)
+
+    if token_cache is None:
+        batch_iter = iter_token_batches(
+            tokenizer, [sent.split() for sent in sentences],
+            max_tokens=max_tokens, max_batch_size=batch_size,
+            is_split_into_words=True, truncation=True
+        )
+    else:
+        # pre-tokenized ids and word alignment, no tokenizer calls in the loop
+        batch_iter = token_cache.iter_batches(token_cache.rows(sentences), max_tokens, batch_size)
+
+    batches = []
+    for batch_idx, tokenized in batch_iter:
+        batch_indices = [verb_indices[i] for i in batch_idx]
+        tokenized = tokenized.to(device)
 
         with torch.no_grad():
-            outputs = model(**tokenized, output_hidden_states=True)
-
-        hidden = outputs.hidden_states[layer_idx]
-        for i in range(hidden.size(0)):
-            word_ids = tokenized.word_ids(batch_index=i)
-            verb_idx = int(batch_indices[i])
-            token_idxs = [j for j, w in enumerate(word_ids) if w == verb_idx]
-            if not token_idxs:
-                raise RuntimeError(f"No tokens for verb index={verb_idx} in batch item {i}")
-            emb = hidden[i, token_idxs, :].mean(dim=0).cpu().numpy()
-            rec = {f'hidden_{k}': float(val) for k, val in enumerate(emb)}
-            rec.update({
-                'language': languages[start + i],
-                'sentence': batch_sent[i],
-                'main_verb': verbs[start + i],
-                'verb_index': verb_idx,
-                'label': labels[start + i]
-            })
-            records.append(rec)
-    return pd.DataFrame.from_records(records)
+            # with no decoder blocks left (layer 0 only) only last_hidden_state is returned
+            model_outputs = model(**tokenized, output_hidden_states=len(layers) > 1, use_cache=False)
+
+        mask = verb_token_mask(tokenized, batch_indices)
+        pooled = []
+        for layer in layers:
+            # after truncation the deepest requested layer is last_hidden_state
+            hidden = (model_outputs.last_hidden_state if layer == layers[-1]
+                      else model_outputs.hidden_states[layer])
+            layer_pooled = pool_verb_tokens(hidden, mask, pooling)
+            pooled.extend(layer_pooled[strategy].to(tokenized['input_ids'].device) for strategy in pooling)
+        # a single device-to-host transfer for the whole batch
+        pooled_cpu = torch.stack(pooled).cpu().numpy()
+        for key, emb in zip(outputs, pooled_cpu):
+            embeddings[key].append(emb)
+        batches.append(batch_idx)
+    # back to the original row order of the split
+    return {key: restore_order(batches, embs) for key, embs in embeddings.items()}
+
+def to_feature_table(emb, df):
+    features = pd.DataFrame(emb, columns=[f'hidden_{k}' for k in range(emb.shape[1])])
+    features['language'] = df['language'].tolist()
+    features['sentence'] = df['sentence'].tolist()
+    features['main_verb'] = df['main_verb'].tolist()
+    features['verb_index'] = df['verb_index'].astype(int).tolist()
+    features['label'] = df['tense'].tolist()
+    return features
+
+def save_features(embeddings, df, split, args):
+    out_files = []
+    if args.output_format == 'store':
+        save_metadata(args.out_dir, split, df)
+    for (layer_idx, strategy), emb in embeddings.items():
+        if args.output_format == 'store':
+            out_files.append(save_activations(args.out_dir, split, layer_idx, pooled_name('hidden', strategy),
+                                              emb, dtype=args.store_dtype))
+            continue
+        suffix = '' if strategy == 'mean' else f'_{strategy}'
+        out_file = os.path.join(args.out_dir, f'llama_{split}_layer{layer_idx}_features{suffix}.csv')
+        to_feature_table(emb, df).to_csv(out_file, index=False, encoding='utf-8-sig')
+        out_files.append(out_file)
+    return out_files
 
 def main():
     args = parse_args()
@@ -84,7 +154,7 @@ def main():
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     dtype = getattr(torch, args.torch_dtype)
-    batch_size = 16
+    batch_size = args.batch_size
 
     tokenizer = AutoTokenizer.from_pretrained(
         args.model_name,
@@ -112,18 +182,28 @@ def main():
         tokenizer.add_special_tokens({'pad_token': tokenizer.eos_token})
         model.resize_token_embeddings(len(tokenizer))
 
+    layers = resolve_layers(args, len(getattr(model, 'model', model).layers))
+    print(f"Extracting hidden layers {layers} from a single forward pass per batch")
+    # stop the forward pass at the deepest requested layer instead of running all blocks
+    model = truncate_hf_model(model, max(layers))
+
     os.makedirs(args.out_dir, exist_ok=True)
 
     df_train = pd.read_csv(args.train_csv, encoding='utf-8-sig')
     df_test = pd.read_csv(args.test_csv, encoding='utf-8-sig')
 
-    features_train = extract_embeddings(df_train, model, tokenizer, device, args.layer_idx, batch_size)
-    features_test = extract_embeddings(df_test, model, tokenizer, device, args.layer_idx, batch_size)
+    token_train = token_test = None
+    if args.token_cache:
+        token_train = TokenCache(args.token_cache, tokenizer, os.path.splitext(os.path.basename(args.train_csv))[0])
+        token_test = TokenCache(args.token_cache, tokenizer, os.path.splitext(os.path.basename(args.test_csv))[0])
+
+    features_train = extract_embeddings(df_train, model, tokenizer, device, layers, batch_size, args.pooling,
+                                        args.max_tokens, token_train)
+    features_test = extract_embeddings(df_test, model, tokenizer, device, layers, batch_size, args.pooling,
+                                       args.max_tokens, token_test)
 
-    train_out = os.path.join(args.out_dir, f'llama_train_layer{args.layer_idx}_features.csv')
-    test_out = os.path.join(args.out_dir, f'llama_test_layer{args.layer_idx}_features.csv')
-    features_train.to_csv(train_out, index=False, encoding='utf-8-sig')
-    features_test.to_csv(test_out, index=False, encoding='utf-8-sig')
+    train_out = save_features(features_train, df_train, 'train', args)
+    test_out = save_features(features_test, df_test, 'test', args)
 
     print("Saved train features to", train_out)
     print("Saved test features to", test_out)
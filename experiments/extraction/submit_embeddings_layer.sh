@@ -8,6 +8,10 @@
 
 cd $PBS_O_WORKDIR
 
+# shared helper modules live at the repository root
+REPO_DIR=$PBS_O_WORKDIR/../..
+cp $REPO_DIR/extraction_utils.py $REPO_DIR/activation_store.py $REPO_DIR/token_cache.py . || { echo >&2 "Error copying helper modules"; exit 3; }
+
 # Load modules (adjust names/versions as needed)
 module load cuda python/3.10
 
@@ -17,18 +21,17 @@ source ./venv/bin/activate
 # Export your HF token so transformers can authenticate
 export HF_TOKEN="..."
 
-# Loop over layer indices
-for LAYER in 0 1; do
-  echo "=== Extracting embeddings from layer $LAYER ==="
-  python3 run_embeddings_layer.py \
-    --train-csv   all_sentences_train.csv \
-    --test-csv    all_sentences_test.csv \
-    --hf-token    $HF_TOKEN \
-    --torch-dtype float16 \
-    --model-name  meta-llama/Llama-3.1-8b \
-    --layer-idx   $LAYER \
-    --out-dir     ./results
-done
+# All requested layers are pooled from the same forward pass (use "all" for every hidden state)
+LAYERS="0 1"
+echo "=== Extracting embeddings from layers $LAYERS ==="
+python3 run_embeddings_layer.py \
+  --train-csv   all_sentences_train.csv \
+  --test-csv    all_sentences_test.csv \
+  --hf-token    $HF_TOKEN \
+  --torch-dtype float16 \
+  --model-name  meta-llama/Llama-3.1-8b \
+  --layers      $LAYERS \
+  --out-dir     ./results
 
 echo "Embedding job completed."
 
@@ -0,0 +1,245 @@
+"""
+Shared helpers for the activation extraction scripts (run_model.py and
+experiments/extraction/run_embeddings_layer.py) and the batched causal
+evaluation loops (run_causal.py and run_interchange.py).
+"""
+import queue
+import threading
+import time
+import numpy as np
+import torch
+
+POOLING_STRATEGIES = ('mean', 'first', 'last')
+
+
+def verb_token_mask(tokenized, verb_indices):
+    """
+    Build the word->token alignment of a tokenized batch once, as a boolean
+    [batch, seq_len] mask marking the sub-tokens of each example's verb.
+    The mask is computed on the CPU from the tokenizer's word_ids, so it does
+    not trigger any device synchronisation.
+    """
+    word_ids = torch.tensor([
+        [-1 if w is None else w for w in tokenized.word_ids(batch_index=i)]
+        for i in range(len(verb_indices))
+    ])
+    verbs = torch.as_tensor([int(v) for v in verb_indices]).unsqueeze(1)
+    mask = word_ids.eq(verbs)
+    missing = (~mask.any(dim=1)).nonzero().flatten().tolist()
+    if missing:
+        i = missing[0]
+        raise RuntimeError(f"No token for verb_index={verb_indices[i]} in example {i}")
+    return mask
+
+
+def pool_verb_tokens(acts, mask, strategies=('mean',)):
+    """
+    Pool the verb sub-tokens of every example of `acts` [batch, seq_len, d]
+    on the activations' device. Returns {strategy: [batch, d] float32 tensor}:
+    'mean' averages all verb sub-tokens, 'first'/'last' take the first/last one.
+    """
+    unknown = set(strategies) - set(POOLING_STRATEGIES)
+    if unknown:
+        raise ValueError(f"Unknown pooling strategies {sorted(unknown)}, expected {POOLING_STRATEGIES}")
+    mask = mask.to(acts.device, non_blocking=True)
+    rows = torch.arange(acts.size(0), device=acts.device)
+    out = {}
+    if 'mean' in strategies:
+        weights = mask.float() / mask.sum(dim=1, keepdim=True)
+        out['mean'] = torch.bmm(weights.unsqueeze(1), acts.float()).squeeze(1)
+    if 'first' in strategies:
+        first = mask.int().argmax(dim=1)
+        out['first'] = acts[rows, first].float()
+    if 'last' in strategies:
+        last = mask.size(1) - 1 - mask.flip(dims=[1]).int().argmax(dim=1)
+        out['last'] = acts[rows, last].float()
+    return out
+
+
+def pooled_name(stream, strategy):
+    # mean pooling keeps the plain stream name used by the existing outputs
+    return stream if strategy == 'mean' else f'{stream}_{strategy}'
+
+
+def truncate_hf_model(model, n_layers):
+    """
+    Drop every decoder block after the first `n_layers` of a Hugging Face
+    Llama-style model (base model or *ForCausalLM) so the forward pass stops
+    at hidden_states[n_layers]. The language-model head is never run: the
+    returned base model has no unembedding. Unless all blocks are kept, the
+    final norm is replaced by an identity so that `last_hidden_state` equals
+    `hidden_states[n_layers]` of the full model.
+    """
+    base = getattr(model, 'model', model)
+    total = len(base.layers)
+    if not 0 <= n_layers <= total:
+        raise ValueError(f"n_layers={n_layers} out of range (0..{total})")
+    if n_layers < total:
+        base.layers = torch.nn.ModuleList(list(base.layers)[:n_layers])
+        base.norm = torch.nn.Identity()
+    return base
+
+
+def token_lengths(tokenizer, texts, **tokenizer_kwargs):
+    return [len(ids) for ids in tokenizer(texts, **tokenizer_kwargs)['input_ids']]
+
+
+def token_budget_batches(lengths, max_tokens=None, max_batch_size=None):
+    """
+    Group example indices into length-bucketed batches. Examples are sorted by
+    token length and packed greedily so that a padded batch (number of examples
+    x longest example) stays within `max_tokens` and, if given, within
+    `max_batch_size` examples. An example longer than the budget gets a batch
+    of its own. Use `restore_order` to put per-batch outputs back in the
+    original order.
+    """
+    if max_tokens is None and max_batch_size is None:
+        raise ValueError("Either max_tokens or max_batch_size is required")
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches, current = [], []
+    for i in order:
+        # lengths are ascending, so example i is the longest of the batch
+        too_many_tokens = max_tokens is not None and (len(current) + 1) * lengths[i] > max_tokens
+        too_many_examples = max_batch_size is not None and len(current) == max_batch_size
+        if current and (too_many_tokens or too_many_examples):
+            batches.append(current)
+            current = []
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def restore_order(batches, outputs):
+    """Concatenate per-batch outputs (arrays over the batch's examples) in the original example order."""
+    order = np.concatenate([np.asarray(b, dtype=np.int64) for b in batches])
+    stacked = np.concatenate(outputs, axis=0)
+    restored = np.empty_like(stacked)
+    restored[order] = stacked
+    return restored
+
+
+def iter_token_batches(tokenizer, texts, max_tokens=None, max_batch_size=None, **tokenizer_kwargs):
+    """
+    Tokenize `texts` in length-bucketed, token-budget batches. Yields
+    (indices, encoding) pairs, where `indices` are the positions of the batch's
+    examples in `texts`; the encoding is padded to the batch's longest example.
+    Works for plain prompts (steering evaluation) as well as pre-split words
+    (is_split_into_words=True, extraction).
+    """
+    lengths = token_lengths(tokenizer, texts, **tokenizer_kwargs)
+    for indices in token_budget_batches(lengths, max_tokens, max_batch_size):
+        encoding = tokenizer(
+            [texts[i] for i in indices],
+            return_tensors='pt',
+            padding=True,
+            **tokenizer_kwargs
+        )
+        yield indices, encoding
+
+
+def slice_kv_cache(cache, rows, length):
+    """
+    New DynamicCache with the first `length` positions of the batch `rows` of `cache`
+    (e.g. [0] * n repeats row 0 n times). It is a copy, so forwards extending it leave
+    `cache` unchanged.
+    """
+    from transformers import DynamicCache
+    out = DynamicCache()
+    for layer in range(len(cache)):
+        keys, values = cache[layer]
+        out.update(keys[rows, :, :length], values[rows, :, :length], layer)
+    return out
+
+
+class PinnedRing:
+    """
+    Ring of reusable pinned host buffers for asynchronous device-to-host copies.
+    A buffer is only reused `n_buffers` copies later, so with a consumer queue of
+    at most n_buffers - 2 pending jobs a buffer is never overwritten while read.
+    """
+
+    def __init__(self, n_buffers):
+        self.buffers = [None] * n_buffers
+        self.next = 0
+
+    def copy(self, tensor):
+        """Start copying `tensor` to the host; returns (host tensor, CUDA event or None)."""
+        if not tensor.is_cuda:
+            return tensor, None
+        buf = self.buffers[self.next]
+        if buf is None or buf.numel() < tensor.numel() or buf.dtype != tensor.dtype:
+            buf = torch.empty(tensor.numel(), dtype=tensor.dtype, pin_memory=True)
+            self.buffers[self.next] = buf
+        self.next = (self.next + 1) % len(self.buffers)
+        host = buf[:tensor.numel()].view(tensor.shape)
+        host.copy_(tensor, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+        return host, event
+
+
+class AsyncWriter:
+    """
+    Background thread running host-side jobs (conversion, serialization,
+    compression, disk writes) from a bounded queue, so the main thread can keep
+    the GPU busy. Errors raised in a job are re-raised on the main thread.
+    """
+
+    def __init__(self, max_pending=4):
+        self.max_pending = max_pending
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    fn, args = job
+                    fn(*args)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError("Background writer job failed") from self.error
+
+    def submit(self, fn, *args):
+        self._check()
+        self.queue.put((fn, args))
+
+    def wait(self):
+        """Block until every submitted job has finished."""
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+
+class Throughput:
+    """Periodic sentences/sec progress report."""
+
+    def __init__(self, name, total, every=30.0):
+        self.name = name
+        self.total = total
+        self.every = every
+        self.done = 0
+        self.start = self.last = time.perf_counter()
+
+    def update(self, n):
+        self.done += n
+        now = time.perf_counter()
+        if now - self.last >= self.every or self.done == self.total:
+            self.last = now
+            rate = self.done / max(now - self.start, 1e-9)
+            print(f'{self.name}: {self.done}/{self.total} sentences, {rate:.1f} sentences/s', flush=True)
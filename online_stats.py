@@ -0,0 +1,184 @@
+"""
+Streaming sufficient statistics of pooled activations.
+
+RunningStats keeps count, mean and per-dimension sum of squared deviations
+(Welford / Chan et al. batch merges, float64) and optionally the covariance:
+either the full d x d co-moment matrix or a rank-k Frequent Directions sketch
+of it. GroupStats keeps one RunningStats per (language, tense) group and is
+saved as a small .npz next to the activations, so class-mean directions,
+Cohen's d, pooled variances and LDA-style probes can be computed without
+loading the N x d activation matrix.
+"""
+import json
+import numpy as np
+
+COVARIANCE_MODES = ('none', 'full', 'lowrank')
+
+
+class RunningStats:
+    def __init__(self, dim, covariance='none', rank=64):
+        if covariance not in COVARIANCE_MODES:
+            raise ValueError(f"Unknown covariance mode '{covariance}', expected one of {COVARIANCE_MODES}")
+        self.dim = dim
+        self.covariance_mode = covariance
+        self.rank = rank
+        self.count = 0
+        self.mean = np.zeros(dim)
+        self.m2 = np.zeros(dim)
+        # co-moment sum_i (x_i - mean)(x_i - mean)^T, or rows B with B^T B approximating it
+        self.comoment = np.zeros((dim, dim)) if covariance == 'full' else None
+        self.sketch = np.zeros((0, dim)) if covariance == 'lowrank' else None
+
+    def _merge(self, n_b, mean_b, m2_b, comoment_b=None, sketch_b=None):
+        n_a = self.count
+        n = n_a + n_b
+        if n_b == 0:
+            return
+        delta = mean_b - self.mean
+        scale = n_a * n_b / n
+        self.mean = self.mean + delta * (n_b / n)
+        self.m2 = self.m2 + m2_b + delta ** 2 * scale
+        if self.comoment is not None:
+            self.comoment += comoment_b + np.outer(delta, delta) * scale
+        if self.sketch is not None:
+            # the rank-1 correction of the merge is one more sketch row
+            rows = [self.sketch, sketch_b, np.sqrt(scale) * delta[None, :]]
+            self.sketch = _shrink(np.concatenate(rows, axis=0), self.rank)
+        self.count = n
+
+    def update(self, x):
+        """Add a [n, dim] block of observations."""
+        x = np.asarray(x, dtype=np.float64)
+        if len(x) == 0:
+            return
+        mean_b = x.mean(axis=0)
+        xc = x - mean_b
+        comoment_b = xc.T @ xc if self.comoment is not None else None
+        sketch_b = _shrink(xc, self.rank) if self.sketch is not None else None
+        self._merge(len(x), mean_b, (xc ** 2).sum(axis=0), comoment_b, sketch_b)
+
+    def merge(self, other):
+        """Fold the statistics of `other` (same dim and covariance mode) into self."""
+        self._merge(other.count, other.mean, other.m2, other.comoment, other.sketch)
+        return self
+
+    def variance(self, ddof=1):
+        return self.m2 / max(self.count - ddof, 1)
+
+    def covariance(self, ddof=1):
+        if self.comoment is not None:
+            return self.comoment / max(self.count - ddof, 1)
+        if self.sketch is not None:
+            return self.sketch.T @ self.sketch / max(self.count - ddof, 1)
+        raise ValueError("Covariance was not tracked (covariance='none')")
+
+
+def _shrink(rows, rank):
+    """Frequent Directions: keep at most `rank` rows whose Gram matrix approximates rows^T rows."""
+    if len(rows) <= rank:
+        return rows
+    _, s, vt = np.linalg.svd(rows, full_matrices=False)
+    if len(s) <= rank:
+        # rank >= dim: the compact SVD is exact
+        return s[:, None] * vt
+    s2 = np.maximum(s[:rank] ** 2 - s[rank] ** 2, 0.0)
+    return np.sqrt(s2)[:, None] * vt[:rank]
+
+
+class GroupStats:
+    """RunningStats per group key, e.g. (language, tense)."""
+
+    def __init__(self, dim, covariance='none', rank=64):
+        self.dim = dim
+        self.covariance_mode = covariance
+        self.rank = rank
+        self.groups = {}
+
+    def _get(self, key):
+        if key not in self.groups:
+            self.groups[key] = RunningStats(self.dim, self.covariance_mode, self.rank)
+        return self.groups[key]
+
+    def update(self, x, keys):
+        """Add [n, dim] observations `x` with one group key per row."""
+        keys = list(keys)
+        by_key = {}
+        for i, key in enumerate(keys):
+            by_key.setdefault(key, []).append(i)
+        for key, rows in by_key.items():
+            self._get(key).update(x[rows])
+
+    def merge(self, other):
+        for key, stats in other.groups.items():
+            self._get(key).merge(stats)
+        return self
+
+    def combined(self, select=lambda key: True):
+        """RunningStats of the union of the groups whose key satisfies `select`."""
+        out = RunningStats(self.dim, self.covariance_mode, self.rank)
+        for key, stats in self.groups.items():
+            if select(key):
+                out.merge(stats)
+        return out
+
+    def save(self, path):
+        keys = list(self.groups)
+        arrays = {
+            'keys': np.array(json.dumps([list(k) for k in keys])),
+            'covariance_mode': np.array(self.covariance_mode),
+            'rank': np.array(self.rank),
+            'count': np.array([self.groups[k].count for k in keys]),
+            'mean': np.stack([self.groups[k].mean for k in keys]) if keys else np.zeros((0, self.dim)),
+            'm2': np.stack([self.groups[k].m2 for k in keys]) if keys else np.zeros((0, self.dim)),
+        }
+        if self.covariance_mode == 'full':
+            arrays['comoment'] = np.stack([self.groups[k].comoment for k in keys])
+        if self.covariance_mode == 'lowrank':
+            sketch = np.zeros((len(keys), self.rank, self.dim))
+            for g, k in enumerate(keys):
+                rows = self.groups[k].sketch
+                sketch[g, :len(rows)] = rows
+            arrays['sketch'] = sketch
+        np.savez(path, **arrays)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        keys = [tuple(k) for k in json.loads(str(data['keys']))]
+        out = cls(data['mean'].shape[1], str(data['covariance_mode']), int(data['rank']))
+        for g, key in enumerate(keys):
+            stats = out._get(key)
+            stats.count = int(data['count'][g])
+            stats.mean = data['mean'][g]
+            stats.m2 = data['m2'][g]
+            if out.covariance_mode == 'full':
+                stats.comoment = data['comoment'][g]
+            if out.covariance_mode == 'lowrank':
+                stats.sketch = data['sketch'][g]
+        return out
+
+
+def diff_in_means(a, b):
+    """Class-mean direction from RunningStats `b` to `a`."""
+    return a.mean - b.mean
+
+
+def pooled_variance(a, b):
+    return (a.m2 + b.m2) / max(a.count + b.count - 2, 1)
+
+
+def cohens_d(a, b):
+    """Per-dimension Cohen's d of `a` versus `b`."""
+    return diff_in_means(a, b) / np.sqrt(pooled_variance(a, b) + 1e-12)
+
+
+def lda_direction(a, b, ridge=1e-3):
+    """
+    Fisher LDA direction separating `a` from `b`, from the pooled within-class
+    covariance (requires covariance='full' or 'lowrank'), with ridge shrinkage.
+    """
+    n = max(a.count + b.count - 2, 1)
+    within = (a.covariance(ddof=0) * a.count + b.covariance(ddof=0) * b.count) / n
+    within += ridge * np.trace(within) / a.dim * np.eye(a.dim)
+    return np.linalg.solve(within, diff_in_means(a, b))
@@ -1,10 +1,16 @@
 # run_causal.py
 import argparse
+import hashlib
+import json
 import os
+import shutil
+import socket
+import time
 import numpy as np
 import torch
 import torch.nn.functional as F
 import pandas as pd
+from contextlib import contextmanager
 from itertools import chain
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from pyvene import (
@@ -13,49 +19,79 @@ from pyvene import (
     IntervenableConfig,
     RepresentationConfig,
     IntervenableModel,
-    VanillaIntervention,
 )
 
+from causal_store import write_prompt_results
+from extraction_utils import slice_kv_cache, token_budget_batches
+from token_cache import TokenCache
+
 # Global placeholders for device and model type
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 MODEL_TYPE = None
 
-def get_gold_joint_original(model, tokenizer, prompt: str, device: torch.device, gold_ids: list[int]) -> float:
-    gold_joint = 1.0
-    curr_prompt = prompt
-    for gold_id in gold_ids:
-        inputs = tokenizer(curr_prompt, return_tensors="pt").to(device)
-        with torch.no_grad():
-            out = model(**inputs)
-        logits = out.logits[0, -1]
-        probs = F.softmax(logits, dim=-1)
-        p_gold = probs[gold_id].item()
-        gold_joint *= p_gold
-        subtok = tokenizer.decode([gold_id], clean_up_tokenization_spaces=False)
-        curr_prompt += subtok
-    return gold_joint
-
-def get_gold_joint_intervened(
-    intervenable,
-    tokenizer,
-    prompt: str,
-    device: torch.device,
-    sources,
-    unit_locations,
-    gold_ids: list[int],
-) -> float:
-    gold_joint = 1.0
-    curr_prompt = prompt
-    for gold_id in gold_ids:
-        inputs = tokenizer(curr_prompt, return_tensors="pt").to(device)
-        _, out = intervenable(inputs, sources, unit_locations=unit_locations)
-        logits = out.logits[0, -1]
-        probs = F.softmax(logits, dim=-1)
-        p_gold = probs[gold_id].item()
-        gold_joint *= p_gold
-        subtok = tokenizer.decode([gold_id], clean_up_tokenization_spaces=False)
-        curr_prompt += subtok
-    return gold_joint
+def prompt_batch(prompt_ids: list[list[int]], gold_ids: list[list[int]], pos_restore: list[list[int]],
+                 pad_token_id: int) -> dict:
+    """
+    Teacher-forced inputs of several prompts (prompt ids followed by all gold tokens but the
+    last, so one forward scores every gold token), left-padded to a common width. The gold
+    tokens of every row end at the last position, position p of prompt i sits at
+    p + offsets[i], and position ids count from the first real token of a row, so a padded
+    row computes what the prompt computes alone.
+    """
+    seqs = [ids + gold[:-1] for ids, gold in zip(prompt_ids, gold_ids)]
+    width = max(len(seq) for seq in seqs)
+    input_ids = torch.full((len(seqs), width), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    for i, seq in enumerate(seqs):
+        input_ids[i, width - len(seq):] = torch.tensor(seq)
+        attention_mask[i, width - len(seq):] = 1
+    position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+    return {
+        "scored": {"input_ids": input_ids.to(DEVICE), "attention_mask": attention_mask.to(DEVICE),
+                   "position_ids": position_ids.to(DEVICE)},
+        "gold_ids": gold_ids,
+        "pos_restore": pos_restore,
+        "offsets": [width - len(seq) for seq in seqs],
+    }
+
+def gold_joint_from_logits(logits, gold_rows: list[list[int]]) -> torch.Tensor:
+    """
+    Joint probability of the gold sequence of every batch row. Rows are prompt_batch rows,
+    so the last len(gold_rows[i]) logits of row i predict gold_rows[i].
+    """
+    n = max(len(ids) for ids in gold_rows)
+    gold = torch.zeros((len(gold_rows), n), dtype=torch.long)
+    mask = torch.zeros((len(gold_rows), n))
+    for i, ids in enumerate(gold_rows):
+        gold[i, n - len(ids):] = torch.tensor(ids)
+        mask[i, n - len(ids):] = 1
+    log_probs = F.log_softmax(logits[:, -n:].float(), dim=-1)
+    log_probs = log_probs.gather(-1, gold.to(logits.device).unsqueeze(-1)).squeeze(-1)
+    return (log_probs * mask.to(logits.device)).sum(dim=-1).exp()
+
+def row_inputs(batch: dict, prompts: list[int]) -> dict:
+    """The scored inputs of `batch` for batch rows of the given prompts."""
+    index = torch.tensor(prompts, device=DEVICE)
+    return {k: v[index] for k, v in batch["scored"].items()}
+
+def noise_locations(batch: dict, prompts: list[int]) -> list[list[int]]:
+    """
+    Noised positions (the restore words) of batch rows of the given prompts. pyvene needs
+    lists of equal length, so shorter lists repeat their first position: a repeated unit is
+    gathered and scattered back with the same value, i.e. it is still noised once.
+    """
+    n = max(len(batch["pos_restore"][p]) for p in prompts)
+    locations = []
+    for p in prompts:
+        # a prompt without restore words gets zero noise (row_noise) on its first token
+        positions = [pos + batch["offsets"][p] for pos in batch["pos_restore"][p]] or [batch["offsets"][p]]
+        locations.append((positions + positions[:1] * n)[:n])
+    return locations
+
+def row_noise(noises: dict, seeds: list[int], batch: dict, prompts: list[int]) -> torch.Tensor:
+    noise = torch.cat([noises[seed] for seed in seeds])
+    noised = torch.tensor([bool(batch["pos_restore"][p]) for p in prompts], device=noise.device)
+    return noise * noised[:, None, None]
 
 def get_restore_positions(few_shot: str, target: str, tokenizer) -> list[int]:
     lines = few_shot.split("\n")
@@ -85,174 +121,972 @@ def get_restore_positions(few_shot: str, target: str, tokenizer) -> list[int]:
             pos_restore.extend(range(i + 1, i + L + 1))
     return sorted(set(pos_restore))
 
+def position_class(pos: int, pos_restore: list[int], final_token_pos: int) -> str:
+    """Role of a restoration position: the first token, the token before the restored words, one of them, or the last token."""
+    if pos == final_token_pos:
+        return "last"
+    if pos in pos_restore:
+        return "restore"
+    if pos_restore and pos == min(pos_restore) - 1:
+        return "before"
+    return "first" if pos == 0 else "other"
+
 class NoiseIntervention(ConstantSourceIntervention, LocalistRepresentationIntervention):
-    def __init__(self, embed_dim=None, seed: int = 1, **kwargs):
+    """Adds Gaussian noise to the intervened units; the noise of every batch row is a runtime input."""
+
+    def __init__(self, embed_dim=None, **kwargs):
         super().__init__()
         embed_dim = embed_dim or kwargs.get("latent_dim")
         if embed_dim is None:
             raise ValueError(f"No latent_dim in kwargs: {list(kwargs)}")
         self.interchange_dim = embed_dim
-        rs = np.random.RandomState(seed)
-        prng = lambda *shape: rs.randn(*shape)
-        self.noise = torch.from_numpy(prng(1, 1, embed_dim)).to(DEVICE)
         self.noise_level = 0.13462981581687927
 
-    def forward(self, base, source=None, subspaces=None):
-        base[..., : self.interchange_dim] += self.noise * self.noise_level
+    def forward(self, base, source=None, subspaces=None, noise=None, **kwargs):
+        base[..., : self.interchange_dim] += noise * self.noise_level
         return base
 
-def corrupted_config(model_type, layer, seed: int = 1) -> IntervenableConfig:
-    return IntervenableConfig(
-        model_type=model_type,
-        representations=[RepresentationConfig(layer, "block_input")],
-        intervention_types=NoiseIntervention,
-        intervention_additional_kwargs=[{"seed": seed}],
-    )
+class CacheIntervention(ConstantSourceIntervention, LocalistRepresentationIntervention):
+    """Records the batch's activations of its (stream, layer) into the runtime `cache` dict; the run is unchanged."""
+
+    def __init__(self, embed_dim=None, layer=None, component=None, **kwargs):
+        super().__init__()
+        self.interchange_dim = embed_dim
+        self.layer = layer
+        self.component = component
+
+    def forward(self, base, source=None, subspaces=None, cache=None, **kwargs):
+        cache[(self.component, self.layer)] = base
+        return base
+
+class RestoreIntervention(ConstantSourceIntervention, LocalistRepresentationIntervention):
+    """
+    Restores clean activations at per-row sites of its layer. The runtime `sites` map
+    a layer to the (rows, positions, prompts) restored there and `clean` is the cache of
+    clean_run; the clean activations of the row's prompt are the constant restoration sources.
+    """
+
+    def __init__(self, embed_dim=None, layer=None, component=None, **kwargs):
+        super().__init__()
+        self.interchange_dim = embed_dim
+        self.layer = layer
+        self.component = component
+
+    def forward(self, base, source=None, subspaces=None, sites=None, clean=None, **kwargs):
+        if self.layer in sites:
+            rows, positions, prompts = sites[self.layer]
+            base[rows, positions] = clean[(self.component, self.layer)][prompts, positions]
+        return base
+
+class HeadRestoreIntervention(RestoreIntervention):
+    """
+    RestoreIntervention on the channels of single attention heads (the o_proj input of its
+    layer is the concatenation of the head outputs): the runtime `sites` map a layer to
+    (rows, positions, prompts, channels), channels [n_sites, head_dim] of the restored head.
+    """
+
+    def forward(self, base, source=None, subspaces=None, sites=None, clean=None, **kwargs):
+        if self.layer in sites:
+            rows, positions, prompts, channels = sites[self.layer]
+            clean_acts = clean[(self.component, self.layer)]
+            base[rows[:, None], positions[:, None], channels] = clean_acts[prompts[:, None], positions[:, None], channels]
+        return base
+
+class ProbeIntervention(ConstantSourceIntervention, LocalistRepresentationIntervention):
+    """
+    Adds a zero tensor that requires grad to the activation of its (stream, layer), so that
+    after a backward pass its .grad is the gradient of the metric w.r.t. that activation.
+    The runtime `probes` dict receives (activation, probe) per (stream, layer).
+    """
+
+    def __init__(self, embed_dim=None, layer=None, component=None, **kwargs):
+        super().__init__()
+        self.interchange_dim = embed_dim
+        self.layer = layer
+        self.component = component
+
+    def forward(self, base, source=None, subspaces=None, probes=None, **kwargs):
+        probe = torch.zeros_like(base, requires_grad=True)
+        probes[(self.component, self.layer)] = (base.detach(), probe)
+        return base + probe
+
+def noise_for_seed(seed: int, embed_dim: int) -> torch.Tensor:
+    rs = np.random.RandomState(seed)
+    return torch.from_numpy(rs.randn(1, 1, embed_dim)).to(DEVICE)
 
-def restore_corrupted_with_interval_config(
-    intervened_layer: int,
-    restore_layer: int,
-    stream: str = "mlp",
-    window: int = 3,
-    num_layers: int = 33,
-    seed: int = 1,
-) -> IntervenableConfig:
+def restore_window(restore_layer: int, window: int, num_layers: int) -> range:
     half = window // 2
-    start = max(0, restore_layer - half)
-    end = min(num_layers, restore_layer + half + 1)
-    reps = []
-    types = []
-    kwargs_list = [{"seed": seed}]
-    reps.append(RepresentationConfig(0, "block_input"))
-    types.append(NoiseIntervention)
-    for L in range(start, end):
+    return range(max(0, restore_layer - half), min(num_layers, restore_layer + half + 1))
+
+def restore_config(stream: str, num_layers: int, restore_type=RestoreIntervention) -> IntervenableConfig:
+    """
+    Noise on the layer-0 block input plus a restoration site on `stream` at every layer.
+    Built once per stream and reused for every batch of cells.
+    """
+    reps = [RepresentationConfig(0, "block_input")]
+    types = [NoiseIntervention]
+    for L in range(num_layers):
         reps.append(RepresentationConfig(L, stream))
-        types.append(VanillaIntervention)
-        kwargs_list.append({})
+        types.append(restore_type)
     return IntervenableConfig(
         model_type=MODEL_TYPE,
         representations=reps,
         intervention_types=types,
-        intervention_additional_kwargs=kwargs_list,
     )
 
-def main():
-    global MODEL_TYPE
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--model_name", type=str, default="meta-llama/Llama-3.1-8b")
-    parser.add_argument("--hf_token", type=str, required=True)
-    parser.add_argument("--json_file", type=str, required=True)
-    parser.add_argument("--m_noise", type=int, default=10)
-    parser.add_argument("--window", type=int, default=1)
-    parser.add_argument("--entry_idx", type=int, required=True)
-    args = parser.parse_args()
+def clean_config(streams: list[str], num_layers: int) -> IntervenableConfig:
+    reps = [RepresentationConfig(L, stream) for stream in streams for L in range(num_layers)]
+    return IntervenableConfig(
+        model_type=MODEL_TYPE,
+        representations=reps,
+        intervention_types=CacheIntervention,
+    )
 
-    print(f"Working directory: {os.getcwd()}", flush=True)
+def clean_run(intervenable, batch: dict):
+    """
+    One clean forward of the prompts of prompt_batch `batch` through the clean_config model:
+    returns the gold probability per prompt, the activations of every stream at every
+    layer, {(stream, layer): [n_prompts, seq_len, dim]}, and the keys and values of every
+    layer (a DynamicCache).
+    """
+    cache = {}
+    with torch.no_grad():
+        _, out = intervenable(batch["scored"], intervention_additional_kwargs={"cache": cache}, use_cache=True)
+    return gold_joint_from_logits(out.logits, batch["gold_ids"]).tolist(), cache, out.past_key_values
 
-    device = DEVICE
-    tokenizer = AutoTokenizer.from_pretrained(args.model_name, token=args.hf_token)
-    model = AutoModelForCausalLM.from_pretrained(
-        args.model_name, device_map="auto", torch_dtype=torch.float16, token=args.hf_token
+def corrupted_config(num_layers: int, residual: bool) -> IntervenableConfig:
+    reps = [RepresentationConfig(0, "block_input")]
+    types = [NoiseIntervention]
+    if residual:
+        # the residual stream entering every block, and leaving the last one
+        for L in range(num_layers):
+            reps.append(RepresentationConfig(L, "block_input"))
+            types.append(CacheIntervention)
+        reps.append(RepresentationConfig(num_layers - 1, "block_output"))
+        types.append(CacheIntervention)
+    return IntervenableConfig(
+        model_type=MODEL_TYPE,
+        representations=reps,
+        intervention_types=types,
     )
-    model.eval()
-    
-    MODEL_TYPE = type(model)
 
-    df = pd.read_json(args.json_file)
-    if args.entry_idx < 0 or args.entry_idx >= len(df):
-        raise IndexError(f"entry_idx {args.entry_idx} out of range (0..{len(df)-1})")
+def seed_rows(batch: dict, n_seeds: int) -> tuple[list[int], list[int]]:
+    """Prompt and noise seed of every row of a (prompt, seed) batch, prompt-major."""
+    n_prompts = len(batch["gold_ids"])
+    return [p for p in range(n_prompts) for _ in range(n_seeds)], list(range(n_seeds)) * n_prompts
 
+def corrupted_run(intervenable, batch: dict, noises: dict):
+    """
+    The corrupted run of every prompt and noise seed in one forward through the
+    corrupted_config model. Returns p_corrupt per prompt and seed and, if that model caches
+    the residual, the corrupted residual stream entering each block: a list of num_layers + 1
+    tensors [n_prompts * n_seeds, seq_len, d_model] (rows as in seed_rows), the last one
+    after the final block.
+    """
+    num_layers = intervenable.model.config.num_hidden_layers
+    n_seeds, n_reps = len(noises), len(intervenable.representations)
+    prompts, seeds = seed_rows(batch, n_seeds)
+    cache = {}
+    with torch.no_grad():
+        _, out = intervenable(
+            row_inputs(batch, prompts),
+            unit_locations={"sources->base": ([None] * n_reps, [noise_locations(batch, prompts)] + [None] * (n_reps - 1))},
+            intervention_additional_kwargs={"noise": row_noise(noises, seeds, batch, prompts), "cache": cache},
+        )
+    probs = gold_joint_from_logits(out.logits, [batch["gold_ids"][p] for p in prompts]).tolist()
+    p_corrupts = [probs[p * n_seeds : (p + 1) * n_seeds] for p in range(len(batch["gold_ids"]))]
+    if not cache:
+        return p_corrupts, None
+    residuals = [cache[("block_input", L)] for L in range(num_layers)]
+    residuals.append(cache[("block_output", num_layers - 1)])
+    return p_corrupts, residuals
 
-    streams = ["block_output", "attention_output", "mlp_activation", "mlp_output"]
+def attribution_config(streams: list[str], num_layers: int) -> IntervenableConfig:
+    reps = [RepresentationConfig(0, "block_input")]
+    types = [NoiseIntervention]
+    for stream in streams:
+        for L in range(num_layers):
+            reps.append(RepresentationConfig(L, stream))
+            types.append(ProbeIntervention)
+    return IntervenableConfig(
+        model_type=MODEL_TYPE,
+        representations=reps,
+        intervention_types=types,
+    )
+
+def attribution_estimates(
+    intervenable,
+    batch: dict,
+    clean: dict,
+    noises: dict,
+    cells: list,
+    streams: list[str],
+    window: int,
+    num_layers: int,
+) -> tuple[list[list[float]], dict]:
+    """
+    Attribution patching: first-order estimate of delta_restored of every (prompt, seed,
+    restore_layer, pos) cell from one corrupted forward and one backward over all prompts and
+    seeds (the clean activations come from clean_run). Restoring a single site changes the
+    gold probability by about (clean - corrupted) . dp/d(activation), with dp = p * dlog(p);
+    a window sums its layers. The forward is the corrupted run, so p_corrupt per prompt and seed
+    comes with it. Returns (p_corrupts, {stream: {cell: estimate}}).
+    """
+    n_seeds, n_reps = len(noises), len(intervenable.representations)
+    prompts, seeds = seed_rows(batch, n_seeds)
+    probes = {}
+    with torch.enable_grad():
+        _, out = intervenable(
+            row_inputs(batch, prompts),
+            unit_locations={"sources->base": ([None] * n_reps, [noise_locations(batch, prompts)] + [None] * (n_reps - 1))},
+            intervention_additional_kwargs={"noise": row_noise(noises, seeds, batch, prompts), "probes": probes},
+        )
+        probs = gold_joint_from_logits(out.logits, [batch["gold_ids"][p] for p in prompts])
+        # rows are independent, so the gradient of the sum is the per-row gradient
+        probs.log().sum().backward()
+    p_corrupt = probs.detach()
+    index = torch.tensor(prompts, device=DEVICE)
+    site_effects = {}
+    for (stream, L), (acts, probe) in probes.items():
+        diff = clean[(stream, L)][index].float().to(acts.device) - acts.float()
+        effect = (diff * probe.grad.float()).sum(dim=-1)
+        site_effects[(stream, L)] = (effect * p_corrupt.to(effect.device)[:, None]).cpu()
+    estimates = {}
+    for stream in streams:
+        estimates[stream] = {
+            (prompt, seed, restore_layer, pos): sum(
+                site_effects[(stream, L)][prompt * n_seeds + seed, pos + batch["offsets"][prompt]].item()
+                for L in restore_window(restore_layer, window, num_layers)
+            )
+            for prompt, seed, restore_layer, pos in cells
+        }
+    probs = p_corrupt.tolist()
+    p_corrupts = [probs[p * n_seeds : (p + 1) * n_seeds] for p in range(len(batch["gold_ids"]))]
+    return p_corrupts, estimates
+
+def agreement_report(exact: list[float], estimated: list[float]) -> dict:
+    exact, estimated = np.asarray(exact), np.asarray(estimated)
+    return {
+        "n_cells": int(len(exact)),
+        "pearson_r": float(np.corrcoef(exact, estimated)[0, 1]) if len(exact) > 1 else float("nan"),
+        "mean_abs_error": float(np.abs(exact - estimated).mean()),
+        "sign_agreement": float((np.sign(exact) == np.sign(estimated)).mean()),
+    }
+
+@contextmanager
+def layers_from(model, start: int):
+    """Run only the decoder blocks from `start` on; inputs_embeds are then the residual entering block `start`."""
+    decoder = model.model
+    layers = decoder.layers
+    decoder.layers = torch.nn.ModuleList(list(layers)[start:])
+    try:
+        yield
+    finally:
+        decoder.layers = layers
+
+def trace_cells(
+    intervenable,
+    batch: dict,
+    clean: dict,
+    noises: dict,
+    cells: list,
+    window: int,
+    num_layers: int,
+    batch_size: int,
+    residuals: list = None,
+    head_dim: int = None,
+    prefix_kv=None,
+    p_corrupts: list = None,
+) -> list[float]:
+    """
+    Gold probability of every (prompt, seed, restore_layer, pos) cell, `batch_size` cells per forward.
+    With `head_dim` a cell ends in (head, positions) and the head's channel slice
+    [head * head_dim, (head + 1) * head_dim) is restored at all the positions.
+    With `residuals` a forward resumes from the cached corrupted residual of its first restored layer;
+    with `prefix_kv` it only runs the positions after its rows' common clean prefix, so every position
+    is offset by that prefix length `shift`, and cells restoring inside the prefix get `p_corrupts`.
+    """
+    n_seeds = len(noises)
+    probs = [None] * len(cells)
+    clean_until = [min(positions) if positions else 0 for positions in batch["pos_restore"]]
+    groups = {}
+    for i, (prompt, seed, restore_layer, site) in enumerate(cells):
+        first_pos = site if head_dim is None else min(site[1])
+        if prefix_kv is not None and first_pos < clean_until[prompt]:
+            probs[i] = p_corrupts[prompt][seed]
+            continue
+        layers = restore_window(restore_layer, window, num_layers)
+        start = 0 if residuals is None else (layers.start if layers else num_layers)
+        groups.setdefault(start, []).append(i)
+    for start, indices in sorted(groups.items()):
+        for b in range(0, len(indices), batch_size):
+            chunk = indices[b : b + batch_size]
+            prompts = [cells[i][0] for i in chunk]
+            seeds = [cells[i][1] for i in chunk]
+            inputs = row_inputs(batch, prompts)
+            noise = row_noise(noises, seeds, batch, prompts)
+            if residuals is not None:
+                # the noise is already part of the cached residual
+                rows = torch.tensor([p * n_seeds + seed for p, seed in zip(prompts, seeds)], device=DEVICE)
+                inputs["inputs_embeds"] = residuals[start][rows.to(residuals[start].device)]
+                del inputs["input_ids"]
+                noise = torch.zeros_like(noise)
+            shift = 0
+            if prefix_kv is not None:
+                shift = min(batch["offsets"][p] + clean_until[p] for p in prompts)
+            chunk_clean = clean
+            if shift:
+                # positions from here on are relative to the first recomputed one
+                inputs = {k: v if k == "attention_mask" else v[:, shift:] for k, v in inputs.items()}
+                inputs["past_key_values"] = slice_kv_cache(prefix_kv, torch.tensor(prompts, device=DEVICE), shift)
+                chunk_clean = {key: acts[:, shift:] for key, acts in clean.items()}
+            sites = {}
+            for row, i in enumerate(chunk):
+                prompt, _, restore_layer, site = cells[i]
+                for L in restore_window(restore_layer, window, num_layers):
+                    if head_dim is None:
+                        units = [(site, [])]
+                    else:
+                        head, positions = site
+                        units = [(pos, list(range(head * head_dim, (head + 1) * head_dim))) for pos in positions]
+                    lists = sites.setdefault(L, ([], [], [], []))
+                    for pos, channels in units:
+                        lists[0].append(row)
+                        lists[1].append(pos + batch["offsets"][prompt] - shift)
+                        lists[2].append(prompt)
+                        lists[3].append(channels)
+            sites = {
+                L: tuple(torch.tensor(v, device=DEVICE) for v in (lists if head_dim else lists[:3]))
+                for L, lists in sites.items()
+            }
+            with torch.no_grad(), layers_from(intervenable.model, start):
+                locations = [[pos - shift for pos in row] for row in noise_locations(batch, prompts)]
+                _, out = intervenable(
+                    inputs,
+                    unit_locations={"sources->base": ([None] * (num_layers + 1), [locations] + [None] * num_layers)},
+                    intervention_additional_kwargs={"noise": noise, "sites": sites, "clean": chunk_clean},
+                )
+            gold_rows = [batch["gold_ids"][p] for p in prompts]
+            for i, p in zip(chunk, gold_joint_from_logits(out.logits, gold_rows).tolist()):
+                probs[i] = p
+    return probs
+
+def ci_halfwidth(deltas: list[float]) -> float:
+    """Half-width of the normal 95% confidence interval of the mean over noise seeds."""
+    if len(deltas) < 2:
+        return float("inf")
+    return 1.96 * float(np.std(deltas, ddof=1)) / np.sqrt(len(deltas))
+
+def adaptive_sweep(
+    run,
+    n_layers: int,
+    positions: list[int],
+    n_seeds: int,
+    coarse_step: int,
+    min_seeds: int,
+    threshold: float,
+    ci_tol: float,
+) -> dict:
+    """
+    Coarse-to-fine sweep: every `coarse_step`-th layer first, refined and given more seeds only around
+    sites whose |mean delta| exceeds `threshold`; returns {cell: delta} of the evaluated cells.
+    """
+    deltas = {}
+
+    def site_deltas(site, seeds):
+        return [deltas[(seed, *site)] for seed in range(seeds)]
+
+    def evaluate(sites):
+        active, seeds = list(sites), 0
+        while active and seeds < n_seeds:
+            new_seeds = range(seeds, min(seeds + (min_seeds if seeds == 0 else 1), n_seeds))
+            cells = [(seed, *site) for seed in new_seeds for site in active]
+            deltas.update(zip(cells, run(cells)))
+            seeds = new_seeds.stop
+            active = [site for site in active if ci_halfwidth(site_deltas(site, seeds)) > ci_tol]
+
+    coarse = sorted(set(range(0, n_layers, coarse_step)) | {n_layers - 1})
+    evaluate([(L, pos) for L in coarse for pos in positions])
+    refine = set()
+    for L in coarse:
+        for pos in positions:
+            evaluated = [d for (seed, L2, p), d in deltas.items() if (L2, p) == (L, pos)]
+            if abs(np.mean(evaluated)) > threshold:
+                refine.update(
+                    (L2, pos) for L2 in range(L - coarse_step + 1, L + coarse_step)
+                    if 0 <= L2 < n_layers and L2 not in coarse
+                )
+    evaluate(sorted(refine))
+    return deltas
+
+STREAMS = ["block_output", "attention_output", "mlp_activation", "mlp_output"]
+
+# input of o_proj: the outputs of all attention heads, concatenated
+HEAD_STREAM = "attention_value_output"
+
+def build_intervenables(model, resume_from_layer: bool = False, attribution: bool = False,
+                        heads: bool = False) -> dict:
+    """The clean, corrupted and per-stream restoration models, built once and reused for every prompt."""
     num_layers = model.config.num_hidden_layers
+    intervenables = {
+        "clean": IntervenableModel(clean_config(STREAMS + [HEAD_STREAM] * heads, num_layers), model),
+    }
+    if resume_from_layer or not attribution:
+        intervenables["corrupted"] = IntervenableModel(corrupted_config(num_layers, resume_from_layer), model)
+    if attribution:
+        intervenables["attribution"] = IntervenableModel(attribution_config(STREAMS, num_layers), model)
+    if heads:
+        intervenables["heads"] = IntervenableModel(
+            restore_config(HEAD_STREAM, num_layers, HeadRestoreIntervention), model
+        )
+    for stream in STREAMS:
+        intervenables[stream] = IntervenableModel(restore_config(stream, num_layers), model)
+    return intervenables
 
-    entry = df.iloc[args.entry_idx]
-    rows = []
+def prepare_entry(entry, tokenizer, token_cache=None) -> dict:
+    """Token ids, gold ids and positions of one prompt entry, in the prompt's own positions."""
     pid, prompt, restore_words, gold = entry.prompt_id, entry.prompt, entry.words_restore, entry.gold
     # parse language & tense
     tense, lang = pid.split("_")
     lang = lang[:2]
 
-    # compute clean baseline once
-    gold_ids = tokenizer.encode(f" {gold}", add_special_tokens=False)
-    p_clean  = get_gold_joint_original(model, tokenizer, prompt, device, gold_ids)
-
     # compute restore positions once
     pos_restore = sorted(set(chain.from_iterable(
         get_restore_positions(prompt, w, tokenizer) for w in restore_words
     )))
-    
-    base = tokenizer(prompt, return_tensors="pt").to(device)
-    
+
+    if token_cache is not None:
+        # pre-tokenized prompt ids shared with the other stages
+        prompt_ids = token_cache.input_ids(token_cache.rows([prompt])[0]).tolist()
+    else:
+        prompt_ids = tokenizer(prompt)["input_ids"]
+
     restoration_positions = []
     restoration_positions.append(0)
     if pos_restore and min(pos_restore) > 0:
         restoration_positions.append(min(pos_restore) - 1)
     restoration_positions.extend(pos_restore)
-    final_token_pos = base.input_ids.size(1) - 1
+    final_token_pos = len(prompt_ids) - 1
     restoration_positions.append(final_token_pos)
-    restoration_positions = sorted(set(restoration_positions))
-    
-    for seed in range(args.m_noise):
-        config_corrupt = corrupted_config(MODEL_TYPE, layer=0, seed=seed)
-        intervenable_corrupt = IntervenableModel(config_corrupt, model)
-        p_corrupt = get_gold_joint_intervened(
-            intervenable_corrupt,
-            tokenizer,
-            prompt,
-            device,
-            sources=None,
-            unit_locations={"base": [[pos_restore]]},
-            gold_ids=gold_ids,
+    return {
+        "pid": pid,
+        "lang": lang,
+        "tense": tense,
+        "gold": gold,
+        # gold answer is scored on token ids, teacher-forced in a single forward
+        "gold_ids": tokenizer.encode(f" {gold}", add_special_tokens=False),
+        "prompt_ids": prompt_ids,
+        "pos_restore": pos_restore,
+        "restoration_positions": sorted(set(restoration_positions)),
+        "final_token_pos": final_token_pos,
+    }
+
+def trace_prompts(entries: list, model, tokenizer, intervenables: dict, args, token_cache=None) -> dict:
+    """All (seed, stream, restore_layer, pos) rows of several prompt entries traced in one batch, {prompt_id: rows}."""
+    num_layers = model.config.num_hidden_layers
+    prompts = [prepare_entry(entry, tokenizer, token_cache) for entry in entries]
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    batch = prompt_batch(
+        [p["prompt_ids"] for p in prompts], [p["gold_ids"] for p in prompts],
+        [p["pos_restore"] for p in prompts], pad_token_id,
+    )
+
+    # the clean run is captured once for all prompts, streams and layers
+    p_cleans, clean, clean_kv = clean_run(intervenables["clean"], batch)
+
+    # sites and noise seeds are runtime inputs of the per-stream intervenable models
+    noises = {seed: noise_for_seed(seed, model.config.hidden_size) for seed in range(args.m_noise)}
+    prompt_cells = [
+        [
+            (i, seed, restore_layer, pos)
+            for seed in range(args.m_noise)
+            for restore_layer in range(33)
+            for pos in p["restoration_positions"]
+        ]
+        for i, p in enumerate(prompts)
+    ]
+    cells = list(chain.from_iterable(prompt_cells))
+    if args.mode == "attribution":
+        # the attribution forward is the corrupted run; the corrupted model only caches residuals
+        p_corrupts, estimates = attribution_estimates(
+            intervenables["attribution"], batch, clean, noises, cells, STREAMS, args.window, num_layers,
         )
-        for stream in streams:
-            for restore_layer in range(33):
-                for pos in restoration_positions:
-                    cfg = restore_corrupted_with_interval_config(
-                        intervened_layer=0,
-                        restore_layer=restore_layer,
-                        stream=stream,
-                        window=args.window,
-                        num_layers=num_layers,
-                        seed=seed,
-                    )
-                    interv = IntervenableModel(cfg, model)
-                    n_restores = len(cfg.representations) - 1
-                    sources = [None] + [base] * n_restores
-                    unit_locations = {
-                        "sources->base": (
-                            [None] + [[[pos]]] * n_restores,
-                            [[pos_restore]] + [[[pos]]] * n_restores,
+        residuals = corrupted_run(intervenables["corrupted"], batch, noises)[1] if args.resume_from_layer else None
+    else:
+        p_corrupts, residuals = corrupted_run(intervenables["corrupted"], batch, noises)
+    trace = dict(
+        batch=batch,
+        clean=clean,
+        noises=noises,
+        window=args.window,
+        num_layers=num_layers,
+        batch_size=args.batch_size,
+        residuals=residuals,
+    )
+    if args.prefix_cache:
+        trace.update(prefix_kv=clean_kv, p_corrupts=p_corrupts)
+    if args.heads:
+        return trace_heads(prompts, p_cleans, p_corrupts, intervenables["heads"], trace, args, model.config)
+    if args.adaptive:
+        # a single prompt; thresholds are fractions of its corruption effect
+        pid, p_corrupt = prompts[0]["pid"], p_corrupts[0]
+        scale = abs(p_cleans[0] - float(np.mean(p_corrupt)))
+        p_restoreds = {}
+        for stream in STREAMS:
+            run = lambda cells, stream=stream: [
+                p - p_corrupt[cell[0]]
+                for cell, p in zip(cells, trace_cells(intervenables[stream], cells=[(0, *c) for c in cells], **trace))
+            ]
+            deltas = adaptive_sweep(
+                run, 33, prompts[0]["restoration_positions"], args.m_noise, args.coarse_step, args.min_seeds,
+                args.refine_threshold * scale, args.ci_tol * scale,
+            )
+            p_restoreds[stream] = {(0, *cell): p_corrupt[cell[0]] + d for cell, d in deltas.items()}
+        evaluated = sum(len(v) for v in p_restoreds.values())
+        exhaustive = len(cells) * len(STREAMS)
+        log = {"evaluated_cells": evaluated, "exhaustive_cells": exhaustive,
+               "saved_fraction": 1 - evaluated / exhaustive}
+        print(f"{pid} adaptive sweep: {evaluated}/{exhaustive} restoration cells "
+              f"({log['saved_fraction']:.0%} saved)", flush=True)
+        with open(os.path.join(args.out_dir, f"{pid}_adaptive.json"), "w") as f:
+            json.dump(log, f, indent=2)
+    elif args.mode == "exact":
+        # one (stream, seed) block at a time, so that finished blocks can be checkpointed
+        finished = [
+            load_checkpoint(args.out_dir, p["pid"], checkpoint_settings(p, args)) if args.checkpoint else {}
+            for p in prompts
+        ]
+        p_restoreds = {stream: {} for stream in STREAMS}
+        for stream in STREAMS:
+            for seed in range(args.m_noise):
+                todo = []
+                for i, cells_i in enumerate(prompt_cells):
+                    if (stream, seed) in finished[i]:
+                        p_restoreds[stream].update(
+                            ((i, seed, L, pos), p) for (L, pos), p in finished[i][(stream, seed)].items()
                         )
-                    }
-                    p_restored = get_gold_joint_intervened(
-                        intervenable=interv,
-                        tokenizer=tokenizer,
-                        prompt=prompt,
-                        device=device,
-                        sources=sources,
-                        unit_locations=unit_locations,
-                        gold_ids=gold_ids,
-                    )
-                    rows.append(
-                        {
-                            "language": lang,
-                            "tense": tense,
+                    else:
+                        todo.extend(cell for cell in cells_i if cell[1] == seed)
+                block = dict(zip(todo, trace_cells(intervenables[stream], cells=todo, **trace)))
+                p_restoreds[stream].update(block)
+                if args.checkpoint:
+                    for i in sorted({cell[0] for cell in todo}):
+                        save_block(args.out_dir, prompts[i]["pid"], stream, seed,
+                                   {(L, pos): p for (j, _, L, pos), p in block.items() if j == i})
+    else:
+        p_restoreds = {
+            stream: {cell: p_corrupts[cell[0]][cell[1]] + est for cell, est in estimates[stream].items()}
+            for stream in STREAMS
+        }
+        # exact re-verification of the top-k cells and of a random validation subset, per prompt
+        verified, validations = set(), []
+        for cells_i in prompt_cells:
+            ranked = sorted(
+                ((stream, cell) for stream in STREAMS for cell in cells_i),
+                key=lambda sc: -abs(estimates[sc[0]][sc[1]]),
+            )
+            all_cells = [(stream, cell) for stream in STREAMS for cell in cells_i]
+            rs = np.random.RandomState(0)
+            n_validate = min(args.validate_cells, len(all_cells))
+            validation = [all_cells[i] for i in rs.choice(len(all_cells), n_validate, replace=False)]
+            verified |= set(ranked[: args.topk]) | set(validation)
+            validations.append(validation)
+        exact = {}
+        for stream in STREAMS:
+            stream_cells = [cell for st, cell in verified if st == stream]
+            exact.update(
+                ((stream, cell), p) for cell, p in
+                zip(stream_cells, trace_cells(intervenables[stream], cells=stream_cells, **trace))
+            )
+        for (stream, cell), p in exact.items():
+            p_restoreds[stream][cell] = p
+        for p, validation in zip(prompts, validations):
+            if not validation:
+                continue
+            report = agreement_report(
+                [exact[sc] - p_corrupts[sc[1][0]][sc[1][1]] for sc in validation],
+                [estimates[sc[0]][sc[1]] for sc in validation],
+            )
+            print(f"{p['pid']} attribution vs exact: {report}", flush=True)
+            with open(os.path.join(args.out_dir, f"{p['pid']}_agreement.json"), "w") as f:
+                json.dump(report, f, indent=2)
+
+    results = {}
+    for i, p in enumerate(prompts):
+        rows = []
+        for seed in range(args.m_noise):
+            p_corrupt = p_corrupts[i][seed]
+            for stream in STREAMS:
+                for restore_layer in range(33):
+                    for pos in p["restoration_positions"]:
+                        cell = (i, seed, restore_layer, pos)
+                        if cell not in p_restoreds[stream]:
+                            continue  # skipped by the adaptive sweep
+                        p_restored = p_restoreds[stream][cell]
+                        row = {
+                            "language": p["lang"],
+                            "tense": p["tense"],
                             "stream": stream,
-                            "prompt_id": pid,
+                            "prompt_id": p["pid"],
                             "pos": pos,
+                            "pos_class": position_class(pos, p["pos_restore"], p["final_token_pos"]),
                             "noise_seed": seed,
                             "restore_layer": restore_layer,
-                            "gold": gold,
-                            "p_clean": p_clean,
+                            "gold": p["gold"],
+                            "p_clean": p_cleans[i],
                             "p_corrupt": p_corrupt,
                             "p_restored": p_restored,
-                            "delta_corrupt": p_clean - p_corrupt,
+                            "delta_corrupt": p_cleans[i] - p_corrupt,
                             "delta_restored": p_restored - p_corrupt,
                         }
-                    )
-    pd.DataFrame(rows).to_csv(f"{pid}.csv", index=False)
-    print(f"Saved {pid}.csv")
+                        if args.mode == "attribution":
+                            row["delta_attribution"] = estimates[stream][cell]
+                            row["exact"] = (stream, cell) in exact
+                        rows.append(row)
+        results[p["pid"]] = rows
+    return results
+
+# Checkpoints of exact sweeps: {out_dir}/_checkpoints/{prompt_id}/{stream}_seed{seed}.json holds
+# the p_restored of every (restore_layer, pos) cell of a finished (seed, stream) block. A block
+# file is written atomically, so its existence records the block as finished.
+CHECKPOINT_DIR = "_checkpoints"
+
+def checkpoint_path(out_dir: str, pid: str) -> str:
+    return os.path.join(out_dir, CHECKPOINT_DIR, pid)
+
+def checkpoint_settings(prompt: dict, args) -> dict:
+    """
+    What the blocks of a prompt depend on; the prompt is hashed from its tokens and restoration
+    positions. The seeds are independent, so a sweep can be resumed with more of them.
+    """
+    traced = {key: prompt[key] for key in ("prompt_ids", "gold_ids", "pos_restore", "restoration_positions")}
+    return {
+        "model_name": args.model_name,
+        "window": args.window,
+        "prompt_sha1": hashlib.sha1(json.dumps(traced, sort_keys=True).encode()).hexdigest(),
+    }
+
+def load_checkpoint(out_dir: str, pid: str, settings: dict) -> dict:
+    """
+    Finished blocks of a prompt, {(stream, seed): {(restore_layer, pos): p_restored}}.
+    A checkpoint written with other `settings` is discarded.
+    """
+    path = checkpoint_path(out_dir, pid)
+    settings_file = os.path.join(path, "settings.json")
+    if os.path.exists(settings_file):
+        with open(settings_file) as f:
+            if json.load(f) != settings:
+                print(f"{pid}: discarding the checkpoint of a sweep with other settings", flush=True)
+                shutil.rmtree(path)
+    if not os.path.exists(settings_file):
+        os.makedirs(path, exist_ok=True)
+        with open(settings_file, "w") as f:
+            json.dump(settings, f)
+    blocks = {}
+    for name in sorted(os.listdir(path)):
+        if name == "settings.json" or not name.endswith(".json"):
+            continue
+        stream, seed = name[: -len(".json")].rsplit("_seed", 1)
+        with open(os.path.join(path, name)) as f:
+            blocks[(stream, int(seed))] = {(L, pos): p for L, pos, p in json.load(f)}
+    if blocks:
+        print(f"{pid}: resuming, {len(blocks)} (stream, seed) blocks already finished", flush=True)
+    return blocks
+
+def save_block(out_dir: str, pid: str, stream: str, seed: int, probs: dict) -> None:
+    out_file = os.path.join(checkpoint_path(out_dir, pid), f"{stream}_seed{seed}.json")
+    tmp_file = out_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump([[L, pos, p] for (L, pos), p in sorted(probs.items())], f)
+    os.replace(tmp_file, out_file)
+
+def trace_heads(prompts: list[dict], p_cleans: list[float], p_corrupts: list[list[float]], intervenable,
+                trace: dict, args, config) -> dict:
+    """
+    Head-level sweep: every (seed, layer, head) cell restores the clean output of one
+    attention head at one layer, at all positions of the `--head_positions` class at once.
+    Cells are batched like restoration cells, so the layer x head grid costs about as much
+    as one stream of the layer sweep per position. Returns {prompt_id: rows}.
+    """
+    num_layers, n_heads = config.num_hidden_layers, config.num_attention_heads
+    cells = []
+    for i, p in enumerate(prompts):
+        positions = p["pos_restore"] if args.head_positions == "restore" else [p["final_token_pos"]]
+        if not positions:
+            continue
+        cells.extend(
+            (i, seed, L, (head, tuple(positions)))
+            for seed in range(args.m_noise)
+            for L in range(num_layers)
+            for head in range(n_heads)
+        )
+    # a head is restored at its own layer only
+    probs = trace_cells(intervenable, cells=cells, **dict(trace, window=1), head_dim=config.hidden_size // n_heads)
+    results = {p["pid"]: [] for p in prompts}
+    for (i, seed, L, (head, _)), p_restored in zip(cells, probs):
+        p = prompts[i]
+        p_corrupt = p_corrupts[i][seed]
+        results[p["pid"]].append({
+            "language": p["lang"],
+            "tense": p["tense"],
+            "stream": "attention_head",
+            "prompt_id": p["pid"],
+            "pos_class": args.head_positions,
+            "noise_seed": seed,
+            "restore_layer": L,
+            "head": head,
+            "gold": p["gold"],
+            "p_clean": p_cleans[i],
+            "p_corrupt": p_corrupt,
+            "p_restored": p_restored,
+            "delta_corrupt": p_cleans[i] - p_corrupt,
+            "delta_restored": p_restored - p_corrupt,
+        })
+    return results
+
+def head_heatmap(rows: list[dict]) -> pd.DataFrame:
+    """Layer x head matrix of delta_restored, averaged over noise seeds."""
+    return pd.DataFrame(rows).pivot_table(index="restore_layer", columns="head", values="delta_restored", aggfunc="mean")
+
+def save_rows(rows: list[dict], out_dir: str, pid: str, output_format: str = "csv") -> str:
+    if output_format == "parquet":
+        return ", ".join(write_prompt_results(out_dir, pid, rows))
+    out_file = os.path.join(out_dir, f"{pid}.csv")
+    tmp_file = out_file + ".tmp"
+    pd.DataFrame(rows).to_csv(tmp_file, index=False)
+    os.replace(tmp_file, out_file)
+    return out_file
+
+# File-based work queue shared by several workers: one file per entry index, moved
+# todo/ -> claimed/ -> done/. os.rename is atomic, so exactly one worker wins a claim; the
+# winner then writes its owner record into the claim, so claims of dead workers can be requeued.
+QUEUE_STATES = ("todo", "claimed", "done")
+
+def init_queue(queue_dir: str, n_entries: int) -> None:
+    """Create the queue with every entry in todo/; a queue that already exists is left as it is."""
+    if os.path.isdir(queue_dir):
+        return
+    tmp_dir = f"{queue_dir}.init-{os.getpid()}"
+    for state in QUEUE_STATES:
+        os.makedirs(os.path.join(tmp_dir, state), exist_ok=True)
+    for idx in range(n_entries):
+        open(os.path.join(tmp_dir, "todo", f"{idx:06d}"), "w").close()
+    try:
+        os.rename(tmp_dir, queue_dir)
+    except OSError:
+        # another worker created the queue first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def claim_owner() -> dict:
+    return {"job": os.environ.get("PBS_JOBID"), "host": socket.gethostname(), "pid": os.getpid(),
+            "claimed_at": time.time()}
+
+def claim_entry(queue_dir: str):
+    for name in sorted(os.listdir(os.path.join(queue_dir, "todo"))):
+        claim_file = os.path.join(queue_dir, "claimed", name)
+        try:
+            os.rename(os.path.join(queue_dir, "todo", name), claim_file)
+        except FileNotFoundError:
+            continue  # claimed by another worker
+        with open(claim_file, "w") as f:
+            json.dump(claim_owner(), f)
+        return name
+    return None
+
+def claim_is_stale(owner: dict, timeout: float) -> bool:
+    """A claim older than `timeout` seconds, or of a dead process on this host; workers elsewhere only time out."""
+    me = claim_owner()
+    if me["claimed_at"] - owner["claimed_at"] > timeout:
+        return True
+    # several workers of one job share the queue, so only a process that is gone is dead
+    if owner["host"] == me["host"] and owner["pid"] != me["pid"]:
+        try:
+            os.kill(owner["pid"], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    return False
+
+def requeue_stale_claims(queue_dir: str, timeout: float) -> None:
+    for name in os.listdir(os.path.join(queue_dir, "claimed")):
+        claim_file = os.path.join(queue_dir, "claimed", name)
+        try:
+            with open(claim_file) as f:
+                owner = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue  # finished, or its owner record is still being written
+        if claim_is_stale(owner, timeout):
+            try:
+                os.rename(claim_file, os.path.join(queue_dir, "todo", name))
+            except FileNotFoundError:
+                continue  # requeued by another worker
+            print(f"Requeued entry {name} of dead worker {owner}", flush=True)
+
+def claim_entries(queue_dir: str, n: int, timeout: float = None) -> list[str]:
+    if timeout is not None:
+        requeue_stale_claims(queue_dir, timeout)
+    names = []
+    while len(names) < n and (name := claim_entry(queue_dir)) is not None:
+        names.append(name)
+    return names
+
+def finish_entry(queue_dir: str, name: str) -> None:
+    """Move a claim of this worker to done/; a claim requeued and taken over by another worker is left to it."""
+    claim_file = os.path.join(queue_dir, "claimed", name)
+    me = claim_owner()
+    try:
+        with open(claim_file) as f:
+            owner = json.load(f)
+    except (FileNotFoundError, ValueError):
+        owner = None
+    if owner is None or (owner["host"], owner["pid"]) != (me["host"], me["pid"]):
+        print(f"Entry {name} is no longer claimed by this worker (owner {owner}), not marking it done", flush=True)
+        return
+    os.rename(claim_file, os.path.join(queue_dir, "done", name))
+
+def requeue_claimed(queue_dir: str) -> None:
+    """Move every claim back to todo/; only run when no worker is active."""
+    for name in os.listdir(os.path.join(queue_dir, "claimed")):
+        os.rename(os.path.join(queue_dir, "claimed", name), os.path.join(queue_dir, "todo", name))
+
+def main():
+    global MODEL_TYPE
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", type=str, default="meta-llama/Llama-3.1-8b")
+    parser.add_argument("--hf_token", type=str, required=True)
+    parser.add_argument("--json_file", type=str, required=True)
+    parser.add_argument("--m_noise", type=int, default=10)
+    parser.add_argument("--window", type=int, default=1)
+    parser.add_argument("--entry_idx", type=int, default=None,
+                        help="Trace a single entry of the JSON file")
+    parser.add_argument("--all_entries", action="store_true",
+                        help="Trace every entry of the JSON file, --prompts_per_batch prompts of "
+                             "similar length at a time")
+    parser.add_argument("--queue_dir", type=str, default=None,
+                        help="Worker mode: load the model once and trace entries claimed from this "
+                             "work queue (created on first use) until it is empty")
+    parser.add_argument("--requeue_claimed", action="store_true",
+                        help="Put all claimed entries back into the queue first (when no worker runs)")
+    parser.add_argument("--claim_timeout", type=float, default=6 * 3600,
+                        help="Worker mode: requeue claims older than this many seconds; set it above "
+                             "the walltime of the workers' jobs")
+    parser.add_argument("--out_dir", type=str, default=".",
+                        help="Directory of the per-prompt {prompt_id}.csv results, or root of the "
+                             "Parquet results store")
+    parser.add_argument("--output_format", choices=["csv", "parquet"], default="csv",
+                        help="parquet: partitioned results store with running heatmap statistics "
+                             "(see causal_store.py)")
+    parser.add_argument("--batch_size", type=int, default=64,
+                        help="Restoration cells evaluated per forward pass")
+    parser.add_argument("--prompts_per_batch", type=int, default=1,
+                        help="Prompts traced together in one left-padded batch; their restoration "
+                             "cells share forward passes")
+    parser.add_argument("--resume_from_layer", action="store_true",
+                        help="Cache the corrupted residual stream per seed and resume every "
+                             "restoration forward at its first restored layer")
+    parser.add_argument("--heads", action="store_true",
+                        help="Head-level sweep instead of the stream sweep: restore the output of "
+                             "single attention heads, written to {prompt_id}_heads.csv and a layer x "
+                             "head {prompt_id}_head_heatmap.csv")
+    parser.add_argument("--head_positions", choices=["restore", "last"], default="restore",
+                        help="heads: restore a head at all restore-word positions, or at the last token")
+    parser.add_argument("--checkpoint", action="store_true",
+                        help="exact mode: flush every finished (seed, stream) block of a prompt to "
+                             "{out_dir}/_checkpoints and skip finished blocks when the sweep is restarted")
+    parser.add_argument("--prefix_cache", action="store_true",
+                        help="Reuse the clean keys and values of the tokens before the first noised "
+                             "position instead of recomputing them in every restoration forward")
+    parser.add_argument("--mode", choices=["exact", "attribution"], default="exact",
+                        help="exact: noise-restore forward per cell; attribution: first-order "
+                             "estimate of every cell from one forward and backward pass")
+    parser.add_argument("--topk", type=int, default=0,
+                        help="attribution mode: re-verify the k largest estimated effects exactly")
+    parser.add_argument("--validate_cells", type=int, default=20,
+                        help="attribution mode: verify this many random cells exactly and "
+                             "write {prompt_id}_agreement.json")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Coarse-to-fine layer sweep with early stopping over noise seeds; "
+                             "only evaluated cells are written")
+    parser.add_argument("--coarse_step", type=int, default=4,
+                        help="adaptive: layer spacing of the coarse grid")
+    parser.add_argument("--min_seeds", type=int, default=3,
+                        help="adaptive: noise seeds evaluated before early stopping is considered")
+    parser.add_argument("--refine_threshold", type=float, default=0.05,
+                        help="adaptive: refine around sites whose |mean delta_restored| exceeds this "
+                             "fraction of |p_clean - p_corrupt|")
+    parser.add_argument("--ci_tol", type=float, default=0.02,
+                        help="adaptive: stop adding seeds once the 95%% CI half-width is below this "
+                             "fraction of |p_clean - p_corrupt|")
+    parser.add_argument("--token_cache", type=str, default=None,
+                        help="Directory of token_cache.py outputs for the prompt JSON")
+    args = parser.parse_args()
+    if args.adaptive and args.mode != "exact":
+        parser.error("--adaptive requires --mode exact")
+    if args.heads and (args.adaptive or args.checkpoint or args.mode != "exact" or args.output_format != "csv"):
+        parser.error("--heads runs an exact sweep with CSV output, without --adaptive or --checkpoint")
+    if args.checkpoint and (args.adaptive or args.mode != "exact"):
+        parser.error("--checkpoint requires --mode exact without --adaptive")
+    if args.adaptive and args.prompts_per_batch > 1:
+        parser.error("--adaptive traces one prompt at a time (--prompts_per_batch 1)")
+    if sum([args.entry_idx is not None, args.all_entries, args.queue_dir is not None]) != 1:
+        parser.error("exactly one of --entry_idx, --all_entries and --queue_dir is required")
+
+    print(f"Working directory: {os.getcwd()}", flush=True)
+
+    df = pd.read_json(args.json_file)
+    if args.entry_idx is not None and (args.entry_idx < 0 or args.entry_idx >= len(df)):
+        raise IndexError(f"entry_idx {args.entry_idx} out of range (0..{len(df)-1})")
+    if args.queue_dir:
+        init_queue(args.queue_dir, len(df))
+        if args.requeue_claimed:
+            requeue_claimed(args.queue_dir)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name, token=args.hf_token)
+    model = AutoModelForCausalLM.from_pretrained(
+        args.model_name, device_map="auto", torch_dtype=torch.float16, token=args.hf_token
+    )
+    model.eval()
+    
+    MODEL_TYPE = type(model)
+    intervenables = build_intervenables(model, args.resume_from_layer, args.mode == "attribution", args.heads)
+
+    token_cache = None
+    if args.token_cache:
+        name = os.path.splitext(os.path.basename(args.json_file))[0]
+        token_cache = TokenCache(args.token_cache, tokenizer, name)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    def trace_and_save(indices):
+        entries = [df.iloc[i] for i in indices]
+        results = trace_prompts(entries, model, tokenizer, intervenables, args, token_cache)
+        for pid, rows in results.items():
+            if args.heads:
+                if rows:
+                    heatmap_file = os.path.join(args.out_dir, f"{pid}_head_heatmap.csv")
+                    head_heatmap(rows).to_csv(heatmap_file)
+                    print(f"Saved {heatmap_file}", flush=True)
+                pid = f"{pid}_heads"
+            print(f"Saved {save_rows(rows, args.out_dir, pid, args.output_format)}", flush=True)
+            if args.checkpoint:
+                shutil.rmtree(checkpoint_path(args.out_dir, pid), ignore_errors=True)
+
+    if args.entry_idx is not None:
+        trace_and_save([args.entry_idx])
+        return
+
+    if args.all_entries:
+        # prompts of similar length share a batch, so little of it is padding
+        lengths = [len(tokenizer(prompt)["input_ids"]) for prompt in df.prompt]
+        for indices in token_budget_batches(lengths, max_batch_size=args.prompts_per_batch):
+            trace_and_save(indices)
+        return
+
+    while names := claim_entries(args.queue_dir, args.prompts_per_batch, args.claim_timeout):
+        trace_and_save([int(name) for name in names])
+        for name in names:
+            finish_entry(args.queue_dir, name)
+    print("Work queue is empty")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Cross-lingual interchange interventions between the translated causal prompts.
+
+Prompt ids are {tense}_{lang}{n} (e.g. pas_en1, pre_de1): prompts with the same n are
+translations of each other. For a base prompt (base language, base tense, n) and a source
+language, the activation of the source prompt (source language, source tense, n) at the
+intervention site (the last token, or the last restore-word token) is patched into the base
+prompt at its own site with a pyvene VanillaIntervention, and the counterfactual gold, the
+gold of (base language, source tense, n), is scored:
+
+    delta = p_patched(counterfactual gold) - p_base(counterfactual gold)
+
+The site activations of every prompt are cached once per (stream, layer) from one clean
+forward per batch of prompts and passed as source representations, so all source -> base
+pairs of a layer take a few batched forwards and no source forward at all. The keys and
+values of the base prompts are kept from their unpatched forward, so a patched forward only
+runs the positions from the intervention site on. The mean delta
+per (stream, layer, source language, base language) is the language transfer matrix.
+
+Usage:
+    python3 run_interchange.py --hf_token $HF_TOKEN \
+        --json_files causal_prompts/translated_prompts_*.json --out_dir interchange
+"""
+import os
+import argparse
+import torch
+import pandas as pd
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+from pyvene import IntervenableConfig, RepresentationConfig, IntervenableModel, VanillaIntervention
+
+from extraction_utils import slice_kv_cache
+from run_causal import (
+    DEVICE,
+    STREAMS,
+    CacheIntervention,
+    prepare_entry,
+    prompt_batch,
+    row_inputs,
+    gold_joint_from_logits,
+)
+
+
+def parse_prompt_id(pid: str) -> tuple[str, str, str]:
+    tense, rest = pid.split("_")
+    return tense, rest[:2], rest[2:]
+
+
+def site_position(prompt: dict, site: str):
+    if site == "last":
+        return prompt["final_token_pos"]
+    return max(prompt["pos_restore"]) if prompt["pos_restore"] else None
+
+
+def cache_site_activations(model, prompts: list[dict], sites: list[int], streams: list[str],
+                           prompts_per_batch: int, pad_token_id: int) -> dict:
+    """Activation of every prompt at its site, {(stream, layer): [n_prompts, dim]}."""
+    num_layers = model.config.num_hidden_layers
+    config = IntervenableConfig(
+        model_type=type(model),
+        representations=[RepresentationConfig(L, stream) for stream in streams for L in range(num_layers)],
+        intervention_types=CacheIntervention,
+    )
+    intervenable = IntervenableModel(config, model)
+    chunks = {}
+    for b in range(0, len(prompts), prompts_per_batch):
+        chunk = prompts[b : b + prompts_per_batch]
+        # the gold tokens follow the prompt, so they do not change its activations
+        batch = prompt_batch([p["prompt_ids"] for p in chunk], [p["gold_ids"] for p in chunk],
+                             [[] for _ in chunk], pad_token_id)
+        cache = {}
+        with torch.no_grad():
+            intervenable(batch["scored"], intervention_additional_kwargs={"cache": cache})
+        rows = torch.arange(len(chunk), device=DEVICE)
+        positions = torch.tensor([(site or 0) + off for site, off in zip(sites[b : b + prompts_per_batch], batch["offsets"])],
+                                 device=DEVICE)
+        for key, acts in cache.items():
+            chunks.setdefault(key, []).append(acts[rows, positions])
+    return {key: torch.cat(parts) for key, parts in chunks.items()}
+
+
+def interchange_pairs(prompts: list[dict], sites: list, tense_pairs: str) -> tuple[list, list]:
+    """
+    Targets (base prompt, counterfactual prompt) scored on the base prompt, and the pairs
+    (target, source prompt) patched into them; prompts are indices into `prompts`.
+    """
+    by_key = {}
+    for i, p in enumerate(prompts):
+        by_key[parse_prompt_id(p["pid"])] = i
+    languages = sorted({lang for _, lang, _ in by_key})
+    targets, pairs = [], []
+    for (base_tense, base_lang, n), base in sorted(by_key.items()):
+        if sites[base] is None:
+            continue
+        for (source_tense, lang, n2), counterfactual in sorted(by_key.items()):
+            if lang != base_lang or n2 != n:
+                continue
+            same = source_tense == base_tense
+            if (tense_pairs == "same" and not same) or (tense_pairs == "different" and same):
+                continue
+            target = len(targets)
+            targets.append((base, counterfactual))
+            for source_lang in languages:
+                source = by_key.get((source_tense, source_lang, n))
+                if source is not None and sites[source] is not None:
+                    pairs.append((target, source))
+    return targets, pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cross-lingual interchange interventions")
+    parser.add_argument("--model_name", type=str, default="meta-llama/Llama-3.1-8b")
+    parser.add_argument("--hf_token", type=str, required=True)
+    parser.add_argument("--json_files", type=str, nargs="+", required=True,
+                        help="Prompt JSONs of all languages (translated_prompts_*.json)")
+    parser.add_argument("--streams", type=str, nargs="+", choices=STREAMS, default=STREAMS)
+    parser.add_argument("--site", choices=["last", "verb"], default="last",
+                        help="Intervention site: the last token, or the last restore-word token")
+    parser.add_argument("--tense_pairs", choices=["different", "same", "all"], default="different",
+                        help="Source/base tense combinations; with 'same' the counterfactual gold "
+                             "is the base gold")
+    parser.add_argument("--prompts_per_batch", type=int, default=16,
+                        help="Prompts per forward when caching the source activations")
+    parser.add_argument("--batch_size", type=int, default=64,
+                        help="Interchange pairs evaluated per forward pass")
+    parser.add_argument("--out_dir", type=str, default=".")
+    args = parser.parse_args()
+
+    df = pd.concat([pd.read_json(path) for path in args.json_files], ignore_index=True)
+    df = df.drop_duplicates("prompt_id")
+    missing_gold = df.gold.fillna("").str.strip() == ""
+    if missing_gold.any():
+        print(f"Skipping {int(missing_gold.sum())} prompts without a gold answer", flush=True)
+        df = df[~missing_gold]
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name, token=args.hf_token)
+    model = AutoModelForCausalLM.from_pretrained(
+        args.model_name, device_map="auto", torch_dtype=torch.float16, token=args.hf_token
+    )
+    model.eval()
+    num_layers = model.config.num_hidden_layers
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+    prompts = [prepare_entry(entry, tokenizer) for entry in df.itertuples()]
+    sites = [site_position(p, args.site) for p in prompts]
+    targets, pairs = interchange_pairs(prompts, sites, args.tense_pairs)
+    if not pairs:
+        raise ValueError(f"No interchange pairs: prompts need a gold answer and a '{args.site}' site, "
+                         f"and translations (same n) in the other languages")
+    print(f"{len(prompts)} prompts, {len(targets)} targets, {len(pairs)} interchange pairs per layer", flush=True)
+
+    source_acts = cache_site_activations(model, prompts, sites, args.streams, args.prompts_per_batch, pad_token_id)
+
+    # every target scores the counterfactual gold after the base prompt
+    batch = prompt_batch(
+        [prompts[base]["prompt_ids"] for base, _ in targets],
+        [prompts[cf]["gold_ids"] for _, cf in targets],
+        [[] for _ in targets], pad_token_id,
+    )
+    gold_rows = [prompts[cf]["gold_ids"] for _, cf in targets]
+    p_base, kv_parts = [], []
+    for b in range(0, len(targets), args.batch_size):
+        index = list(range(b, min(b + args.batch_size, len(targets))))
+        with torch.no_grad():
+            out = model(**row_inputs(batch, index), use_cache=True)
+        p_base.extend(gold_joint_from_logits(out.logits, [gold_rows[i] for i in index]).tolist())
+        kv_parts.append(out.past_key_values)
+    # positions before the intervention site are the same in the patched forwards
+    target_kv = DynamicCache()
+    for layer in range(num_layers):
+        target_kv.update(torch.cat([part[layer][0] for part in kv_parts]),
+                         torch.cat([part[layer][1] for part in kv_parts]), layer)
+    del kv_parts
+
+    rows = []
+    for stream in args.streams:
+        for L in range(num_layers):
+            config = IntervenableConfig(
+                model_type=type(model),
+                representations=[RepresentationConfig(L, stream)],
+                intervention_types=VanillaIntervention,
+            )
+            intervenable = IntervenableModel(config, model)
+            key = list(intervenable.representations)[0]
+            for b in range(0, len(pairs), args.batch_size):
+                chunk = pairs[b : b + args.batch_size]
+                target_rows = [t for t, _ in chunk]
+                sources = torch.tensor([s for _, s in chunk], device=DEVICE)
+                positions = [sites[targets[t][0]] + batch["offsets"][t] for t in target_rows]
+                shift = min(positions)
+                inputs = {k: v if k == "attention_mask" else v[:, shift:]
+                          for k, v in row_inputs(batch, target_rows).items()}
+                inputs["past_key_values"] = slice_kv_cache(target_kv, torch.tensor(target_rows, device=DEVICE), shift)
+                with torch.no_grad():
+                    _, out = intervenable(
+                        inputs,
+                        unit_locations={"sources->base": (None, [[[pos - shift] for pos in positions]])},
+                        source_representations={key: source_acts[(stream, L)][sources][:, None]},
+                    )
+                probs = gold_joint_from_logits(out.logits, [gold_rows[t] for t in target_rows]).tolist()
+                for (t, source), p_patched in zip(chunk, probs):
+                    base, cf = targets[t]
+                    base_tense, base_lang, n = parse_prompt_id(prompts[base]["pid"])
+                    source_tense, source_lang, _ = parse_prompt_id(prompts[source]["pid"])
+                    rows.append({
+                        "stream": stream,
+                        "layer": L,
+                        "source_language": source_lang,
+                        "base_language": base_lang,
+                        "source_tense": source_tense,
+                        "base_tense": base_tense,
+                        "prompt_n": n,
+                        "source_prompt_id": prompts[source]["pid"],
+                        "base_prompt_id": prompts[base]["pid"],
+                        "counterfactual_gold": prompts[cf]["gold"],
+                        "p_base": p_base[t],
+                        "p_patched": p_patched,
+                        "delta": p_patched - p_base[t],
+                    })
+        print(f"{stream}: {len(pairs)} pairs x {num_layers} layers done", flush=True)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    results = pd.DataFrame(rows)
+    out_file = os.path.join(args.out_dir, f"interchange_{args.site}_{args.tense_pairs}.csv")
+    results.to_csv(out_file, index=False)
+    matrix = (results.groupby(["stream", "layer", "source_language", "base_language"])["delta"]
+              .agg(["mean", "count"]).reset_index())
+    matrix_file = os.path.join(args.out_dir, f"interchange_{args.site}_{args.tense_pairs}_matrix.csv")
+    matrix.to_csv(matrix_file, index=False)
+    print(f"Saved {out_file} and {matrix_file}")
+
+
+if __name__ == "__main__":
+    main()
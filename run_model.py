@@ -1,16 +1,37 @@
 #!/usr/bin/env python3
 """
 Script to extract Llama-3.1 8B activations from attention, MLP, and residual streams
-at specified hidden layers, using HookedTransformer, and save as Parquet files.
+at specified hidden layers, using HookedTransformer, and save them either to a
+memory-mappable activation store (default, see activation_store.py) or as Parquet files.
+All requested (layer, stream) hooks are captured from a single forward pass per batch.
 Processes first 240 examples per tense label in train set and 60 per label in test set.
+
+Data-parallel runs: --workers N launches N local worker processes (one GPU each when
+available) and merges their outputs; on several nodes, run each with --num-shards N
+--shard-index i and afterwards once with --merge-shards N.
 """
 import os
+import sys
+import shutil
 import argparse
+import functools
+import subprocess
+import numpy as np
 import pandas as pd
 import torch
 from transformer_lens import HookedTransformer
 from transformers import AutoTokenizer, AutoModelForCausalLM
 
+from activation_store import (
+    ExtractionCache, list_shards, load_activations, load_metadata, save_activations, save_metadata
+)
+from online_stats import COVARIANCE_MODES, GroupStats
+from token_cache import TokenCache
+from extraction_utils import (
+    POOLING_STRATEGIES, AsyncWriter, PinnedRing, Throughput, iter_token_batches, pool_verb_tokens,
+    pooled_name, restore_order, verb_token_mask
+)
+
 
 STREAM_HOOKS = {
     'attention': 'blocks.{layer}.hook_attn_out',
@@ -29,7 +50,40 @@ def parse_args():
     parser.add_argument('--out-dir', type=str, default='./results')
     parser.add_argument('--hf-token', type=str, required=True)
     parser.add_argument('--torch-dtype', type=str, default='bfloat16')
-    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help='Maximum number of sentences per batch')
+    parser.add_argument('--max-tokens', type=int, default=None,
+                        help='Token budget per padded batch (sentences are bucketed by length)')
+    parser.add_argument('--output-format', type=str, default='store',
+                        choices=['store', 'parquet'],
+                        help='store: .npy shards + metadata sidecar; parquet: one wide table per (layer, stream)')
+    parser.add_argument('--store-dtype', type=str, default='float16',
+                        choices=['float16', 'float32'])
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Resumable extraction cache; completed shards are skipped on rerun')
+    parser.add_argument('--shard-rows', type=int, default=512,
+                        help='Rows per cache shard (progress is saved after every shard)')
+    parser.add_argument('--token-cache', type=str, default=None,
+                        help='Directory of token_cache.py outputs; skips tokenization in the extraction loop')
+    parser.add_argument('--writer-queue', type=int, default=4,
+                        help='Maximum number of batches queued for the background writer')
+    parser.add_argument('--stats', type=str, default='off',
+                        choices=['off', 'diag'] + [m for m in COVARIANCE_MODES if m != 'none'],
+                        help='Save per-(language, tense) running mean/variance (diag), plus full or '
+                             'low-rank covariance, next to the activations')
+    parser.add_argument('--stats-rank', type=int, default=64,
+                        help='Sketch rank for --stats lowrank')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Launch this many local worker processes and merge their outputs')
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help='Number of data-parallel workers the rows are split across')
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help='Rows (contiguous slice) handled by this worker')
+    parser.add_argument('--merge-shards', type=int, default=None,
+                        help='Only merge the outputs of this many workers into --out-dir')
+    parser.add_argument('--pooling', type=str, nargs='+', default=['mean'],
+                        choices=list(POOLING_STRATEGIES),
+                        help='Verb sub-token pooling strategies, all computed in the same pass')
     return parser.parse_args()
 
 
@@ -42,70 +96,282 @@ def load_data(path, n_per_label):
     return pd.concat(frames, ignore_index=True)
 
 
-def extract_stream(tokenized, verb_indices, hook_name, model):
+def extract_streams(tokenized, verb_indices, hook_names, model, pooling=('mean',), stop_at_layer=None):
     input_ids = tokenized['input_ids'].to(model.cfg.device)
     attention_mask = tokenized['attention_mask'].to(model.cfg.device)
-    # Use correct signature: tokens tensor and attention_mask keyword
-    _, cache = model.run_with_cache(input_ids, attention_mask=attention_mask)
-    acts = cache[hook_name]
-    out = []
-    for i, vidx in enumerate(verb_indices):
-        word_ids = tokenized.word_ids(batch_index=i)
-        positions = [pos for pos, w in enumerate(word_ids) if w == vidx]
-        if not positions:
-            raise RuntimeError(f"No token for verb_index={vidx} in example {i}")
-        sub_embs = acts[i, positions, :]
-        emb = sub_embs.mean(dim=0).cpu().numpy()
-        out.append(emb)
-    return torch.tensor(out)
-
-
-def process_split(df, model, tokenizer, layers, split_name, n_per_label, batch_size, out_dir):
+    mask = verb_token_mask(tokenized, verb_indices)
+    # Use correct signature: tokens tensor and attention_mask keyword;
+    # only the requested hooks are kept in the cache and the forward pass
+    # stops after the deepest requested block (no unembedding / logits)
+    _, cache = model.run_with_cache(
+        input_ids,
+        attention_mask=attention_mask,
+        names_filter=list(hook_names),
+        stop_at_layer=stop_at_layer
+    )
+    keys, pooled = [], []
+    for hook_name in hook_names:
+        for strategy, emb in pool_verb_tokens(cache[hook_name], mask, pooling).items():
+            keys.append((hook_name, strategy))
+            pooled.append(emb.to(input_ids.device))
+    # the whole batch is moved to the host in a single transfer by the caller
+    return keys, torch.stack(pooled)
+
+
+def extract_rows(rows, verbs, model, batches_for, hook_names, outputs, pooling,
+                 stop_at_layer, writer, ring, progress, on_done, on_batch=None):
+    """
+    Run the forward passes for `rows` (tokenized batch by batch by `batches_for`) on the calling thread while the pooled
+    activations are copied to pinned host memory asynchronously and collected
+    on the writer thread. `on_done` receives {output: [len(rows), d] array} in
+    the order of `rows`, also on the writer thread; `on_batch` receives the rows
+    and {output: [batch, d] array} of every batch as soon as it arrives.
+    """
+    embeddings = {key: [] for key in outputs}
+    batches = []
+
+    def collect(batch_idx, keys, host, event):
+        if event is not None:
+            event.synchronize()
+        for key, emb in zip(keys, host.numpy()):
+            embeddings[key].append(emb.copy())
+        if on_batch is not None:
+            on_batch([rows[i] for i in batch_idx], {key: emb[-1] for key, emb in embeddings.items()})
+
+    def finish():
+        # back to the order of `rows`
+        on_done({key: restore_order(batches, embs) for key, embs in embeddings.items()})
+
+    # iterate in length-bucketed batches, tokenized with word alignment
+    for batch_idx, tokenized in batches_for(rows):
+        batch_verbs = [verbs[rows[i]] for i in batch_idx]
+        # extract activations for all hooks at once
+        keys, pooled = extract_streams(tokenized, batch_verbs, hook_names, model, pooling,
+                                       stop_at_layer=stop_at_layer)
+        host, event = ring.copy(pooled)
+        writer.submit(collect, batch_idx, keys, host, event)
+        batches.append(batch_idx)
+        progress.update(len(batch_idx))
+    writer.submit(finish)
+
+
+def process_split(df, model, tokenizer, layers, split_name, n_per_label, batch_size, out_dir,
+                  output_format='store', store_dtype='float16', pooling=('mean',), max_tokens=None,
+                  cache=None, writer=None, token_cache=None, stats_mode='off', stats_rank=64):
     os.makedirs(out_dir, exist_ok=True)
+    own_writer = writer is None
+    if own_writer:
+        writer = AsyncWriter()
+    ring = PinnedRing(writer.max_pending + 2)
     # Prepare dataframes per batch
     sentences = df['sentence'].tolist()
     verbs = df['verb_index'].tolist()
-    metadata = df[['language','sentence','main_verb','verb_index','tense']]
-
-    for layer in layers:
-        for stream_name, hook_fmt in STREAM_HOOKS.items():
-            hook_name = hook_fmt.format(layer=layer)
-            records = []
-            # iterate in batches
-            for start in range(0, len(sentences), batch_size):
-                batch_sent = sentences[start:start+batch_size]
-                batch_verbs = verbs[start:start+batch_size]
-                # tokenize with word alignment
-                tokenized = tokenizer(
-                    [s.split() for s in batch_sent],
-                    is_split_into_words=True,
-                    return_tensors='pt',
-                    padding=True,
-                    truncation=True
-                )
-                # extract activations
-                emb_batch = extract_stream(tokenized, batch_verbs, hook_name, model)
-                # collect records
-                for i, emb in enumerate(emb_batch.numpy()):
-                    rec = {f'{stream_name}_{j}': float(v)
-                           for j, v in enumerate(emb)}
-                    md = metadata.iloc[start + i].to_dict()
-                    rec.update({'layer': layer, 'stream': stream_name, **md})
-                    records.append(rec)
-
-            df_out = pd.DataFrame.from_records(records)
-            out_file = os.path.join(
-                out_dir,
-                f'llama_{split_name}_layer{layer}_{stream_name}.parquet'
+    metadata = df[['language','sentence','main_verb','verb_index','tense']].reset_index(drop=True)
+
+    # every (layer, stream, pooling) output is captured from the same forward pass
+    outputs = {
+        (layer, pooled_name(stream_name, strategy)): (hook_fmt.format(layer=layer), strategy)
+        for layer in layers
+        for stream_name, hook_fmt in STREAM_HOOKS.items()
+        for strategy in pooling
+    }
+    hook_names = list(dict.fromkeys(hook_name for hook_name, _ in outputs.values()))
+
+    # running per-(language, tense) statistics, updated batch by batch on the writer thread
+    stats = {}
+    group_keys = list(zip(metadata['language'], metadata['tense']))
+
+    def update_stats(rows, result):
+        for key, emb in result.items():
+            if key not in stats:
+                covariance = 'none' if stats_mode == 'diag' else stats_mode
+                stats[key] = GroupStats(emb.shape[1], covariance=covariance, rank=stats_rank)
+            stats[key].update(emb, [group_keys[i] for i in rows])
+
+    if token_cache is None:
+        def batches_for(rows):
+            return iter_token_batches(
+                tokenizer, [sentences[i].split() for i in rows],
+                max_tokens=max_tokens, max_batch_size=batch_size,
+                is_split_into_words=True, truncation=True
             )
-            df_out.to_parquet(out_file, index=False)
-            print(f'Saved {out_file}: {df_out.shape}')
+    else:
+        # pre-tokenized ids and word alignment, no tokenizer calls in the loop
+        cache_rows = token_cache.rows(sentences)
+
+        def batches_for(rows):
+            return token_cache.iter_batches([cache_rows[i] for i in rows], max_tokens, batch_size)
+
+    def extract(rows, progress, on_done):
+        extract_rows(rows, verbs, model, batches_for, hook_names,
+                     list(outputs.values()), pooling, max(layers) + 1,
+                     writer, ring, progress, on_done, update_stats if stats_mode != 'off' else None)
+
+    if cache is None:
+        embeddings = {}
+        rows = list(range(len(sentences)))
+        extract(rows, Throughput(split_name, len(rows)), embeddings.update)
+        writer.wait()
+    else:
+        # only rows missing from the cache for any output are recomputed,
+        # and they are flushed to the cache shard by shard
+        row_keys = {
+            key: cache.row_keys(sentences, verbs, f'{key[0]}:{key[1]}')
+            for key in outputs.values()
+        }
+        pending = sorted(set().union(*(cache.missing(keys) for keys in row_keys.values())))
+        print(f'{split_name}: {len(sentences) - len(pending)} cached rows, {len(pending)} to extract')
+        progress = Throughput(split_name, len(pending))
+
+        def write_shards(rows, result):
+            for key, emb in result.items():
+                cache.write(f'{key[0]}:{key[1]}', [row_keys[key][i] for i in rows], emb)
+
+        for start in range(0, len(pending), cache.shard_rows):
+            rows = pending[start:start + cache.shard_rows]
+            extract(rows, progress, functools.partial(write_shards, rows))
+        writer.wait()
+        if stats_mode != 'off':
+            # rows served from the cache are read back one shard-sized chunk at a time
+            cached = sorted(set(range(len(sentences))) - set(pending))
+            for start in range(0, len(cached), cache.shard_rows):
+                rows = cached[start:start + cache.shard_rows]
+                update_stats(rows, {key: cache.gather([keys[i] for i in rows]) for key, keys in row_keys.items()})
+        embeddings = {key: cache.gather(keys) for key, keys in row_keys.items()}
+
+    # serialization and compression of the outputs overlap with the next split
+    if output_format == 'store':
+        writer.submit(write_metadata, out_dir, split_name, metadata)
+
+    # fan the pooled vectors out to the per-(layer, stream) outputs
+    for (layer, stream_name), key in outputs.items():
+        emb = embeddings.pop(key)
+        writer.submit(write_output, out_dir, split_name, layer, stream_name,
+                      emb, metadata, output_format, store_dtype)
+        if key in stats:
+            writer.submit(write_stats, out_dir, split_name, layer, stream_name, stats.pop(key), output_format)
+
+    if own_writer:
+        writer.close()
+
+
+def write_metadata(out_dir, split_name, metadata):
+    meta_file = save_metadata(out_dir, split_name, metadata)
+    print(f'Saved {meta_file}: {metadata.shape}')
+
+
+def write_output(out_dir, split_name, layer, stream_name, emb, metadata, output_format, store_dtype):
+    if output_format == 'store':
+        out_file = save_activations(out_dir, split_name, layer, stream_name,
+                                    emb, dtype=store_dtype)
+        print(f'Saved {out_file}: {emb.shape}')
+        return
+    df_emb = pd.DataFrame(
+        emb, columns=[f'{stream_name}_{j}' for j in range(emb.shape[1])]
+    )
+    df_out = pd.concat([df_emb, metadata], axis=1)
+    df_out['layer'] = layer
+    df_out['stream'] = stream_name
+    df_out = df_out[list(df_emb.columns) + ['layer', 'stream'] + list(metadata.columns)]
+    out_file = os.path.join(
+        out_dir,
+        f'llama_{split_name}_layer{layer}_{stream_name}.parquet'
+    )
+    df_out.to_parquet(out_file, index=False)
+    print(f'Saved {out_file}: {df_out.shape}')
+
+
+def stats_path(out_dir, split_name, layer, stream_name, output_format):
+    if output_format == 'store':
+        return os.path.join(out_dir, split_name, f'stats_layer{layer}_{stream_name}.npz')
+    return os.path.join(out_dir, f'llama_{split_name}_layer{layer}_{stream_name}_stats.npz')
+
+
+def write_stats(out_dir, split_name, layer, stream_name, stats, output_format):
+    out_file = stats_path(out_dir, split_name, layer, stream_name, output_format)
+    stats.save(out_file)
+    print(f'Saved {out_file}: {len(stats.groups)} groups')
+
+
+def shard_dir(out_dir, shard_index, num_shards):
+    return os.path.join(out_dir, 'shards', f'shard{shard_index}of{num_shards}')
+
+
+def shard_rows(df, shard_index, num_shards):
+    # contiguous, deterministic slice so that the merge is a concatenation
+    rows = np.array_split(np.arange(len(df)), num_shards)[shard_index]
+    return df.iloc[rows].reset_index(drop=True)
+
+
+def merge_shards(out_dir, split_name, num_shards, output_format, store_dtype, stats_mode):
+    """Concatenate the worker outputs of a split into the same store a single-process run writes."""
+    dirs = [shard_dir(out_dir, i, num_shards) for i in range(num_shards)]
+    metadata = pd.concat([load_metadata(d, split_name) for d in dirs], ignore_index=True)
+    for col in metadata.columns:
+        if isinstance(metadata[col].dtype, pd.CategoricalDtype):
+            metadata[col] = metadata[col].astype(object)
+    if output_format == 'store':
+        write_metadata(out_dir, split_name, metadata)
+    for layer, stream_name in list_shards(dirs[0], split_name):
+        emb = np.concatenate([load_activations(d, split_name, layer, stream_name) for d in dirs])
+        write_output(out_dir, split_name, layer, stream_name, emb, metadata, output_format, store_dtype)
+        if stats_mode != 'off':
+            # the workers' running statistics are merged, not recomputed
+            stats = GroupStats.load(stats_path(dirs[0], split_name, layer, stream_name, 'store'))
+            for d in dirs[1:]:
+                stats.merge(GroupStats.load(stats_path(d, split_name, layer, stream_name, 'store')))
+            write_stats(out_dir, split_name, layer, stream_name, stats, output_format)
+
+
+def worker_argv(argv, shard_index, num_shards):
+    out, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+            continue
+        if arg == '--workers':
+            skip = True
+            continue
+        if arg.startswith('--workers='):
+            continue
+        out.append(arg)
+    return out + ['--num-shards', str(num_shards), '--shard-index', str(shard_index)]
+
+
+def launch_workers(num_workers):
+    """Run one worker process per shard, spread round-robin over the visible GPUs."""
+    n_gpus = torch.cuda.device_count()
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    gpu_ids = visible.split(',')[:n_gpus] if visible else [str(g) for g in range(n_gpus)]
+    procs = []
+    for i in range(num_workers):
+        env = dict(os.environ)
+        if n_gpus > 0:
+            env['CUDA_VISIBLE_DEVICES'] = gpu_ids[i % n_gpus]
+        else:
+            env['OMP_NUM_THREADS'] = str(max(1, (os.cpu_count() or 1) // num_workers))
+        cmd = [sys.executable, os.path.abspath(__file__)] + worker_argv(sys.argv[1:], i, num_workers)
+        procs.append(subprocess.Popen(cmd, env=env))
+    failed = [i for i, p in enumerate(procs) if p.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Extraction workers {failed} failed")
 
 
 def main():
     args = parse_args()
+    if args.workers > 1:
+        launch_workers(args.workers)
+        args.merge_shards = args.workers
+    if args.merge_shards:
+        for split_name in ('train', 'test'):
+            merge_shards(args.out_dir, split_name, args.merge_shards, args.output_format,
+                         args.store_dtype, args.stats)
+        shutil.rmtree(os.path.join(args.out_dir, 'shards'))
+        return
+
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     dtype = getattr(torch, args.torch_dtype)
+    torch.set_grad_enabled(False)
 
     # load tokenizer and model
     tokenizer = AutoTokenizer.from_pretrained(
@@ -113,7 +379,7 @@ def main():
         trust_remote_code=True,
         use_fast=True,
         padding_side='left',
-        token=hf_token
+        token=args.hf_token
     )
 
     # ensure pad_token exists for batch padding
@@ -137,16 +403,55 @@ def main():
         device=device,
         dtype=dtype
     ).eval()
+    # the weights now live in the HookedTransformer; free the HF copy
+    del model_hf
+    if args.stats == 'full' and model.cfg.d_model >= 1024:
+        gb = model.cfg.d_model ** 2 * 8 / 1e9
+        print(f'Warning: --stats full keeps a {gb:.2f} GB float64 co-moment matrix per (language, tense) '
+              f'group and output at d_model={model.cfg.d_model}; consider --stats lowrank')
+
+    out_dir, output_format, store_dtype, stats_mode = args.out_dir, args.output_format, args.store_dtype, args.stats
+    manifest_name = 'manifest.jsonl'
+    if args.num_shards > 1:
+        # workers write plain store shards and their own statistics; the merge produces the formats
+        out_dir = shard_dir(args.out_dir, args.shard_index, args.num_shards)
+        output_format = 'store'
+        store_dtype = 'float32' if args.output_format == 'parquet' else args.store_dtype
+        manifest_name = f'manifest-{args.shard_index}of{args.num_shards}.jsonl'
+
+    cache = None
+    if args.cache_dir:
+        cache = ExtractionCache(args.cache_dir, args.model_name, args.torch_dtype,
+                                shard_rows=args.shard_rows, store_dtype=args.store_dtype,
+                                manifest_name=manifest_name)
+
+    # host-side collection and writing run on a background thread
+    writer = AsyncWriter(max_pending=args.writer_queue)
 
     df_train = load_data(args.train_csv, n_per_label=240)
     df_test = load_data(args.test_csv, n_per_label=60)
+    if args.num_shards > 1:
+        df_train = shard_rows(df_train, args.shard_index, args.num_shards)
+        df_test = shard_rows(df_test, args.shard_index, args.num_shards)
+
+    token_train = token_test = None
+    if args.token_cache:
+        token_train = TokenCache(args.token_cache, tokenizer, os.path.splitext(os.path.basename(args.train_csv))[0])
+        token_test = TokenCache(args.token_cache, tokenizer, os.path.splitext(os.path.basename(args.test_csv))[0])
 
     process_split(df_train, model, tokenizer,
                   args.layers, 'train', 240,
-                  args.batch_size, args.out_dir)
+                  args.batch_size, out_dir,
+                  output_format, store_dtype, args.pooling,
+                  args.max_tokens, cache, writer, token_train,
+                  stats_mode, args.stats_rank)
     process_split(df_test, model, tokenizer,
                   args.layers, 'test', 60,
-                  args.batch_size, args.out_dir)
+                  args.batch_size, out_dir,
+                  output_format, store_dtype, args.pooling,
+                  args.max_tokens, cache, writer, token_test,
+                  stats_mode, args.stats_rank)
+    writer.close()
 
 
 if __name__ == '__main__':
@@ -15,6 +15,7 @@ test -n "$SCRATCHDIR" || { echo >&2 "Variable SCRATCHDIR is not set!"; exit 1; }
 
 cp -r $DATADIR/causal/causal_prompts $SCRATCHDIR || { echo >&2 "Error while copying JSON input!"; exit 2; }
 cp $DATADIR/causal/run_causal.py $SCRATCHDIR || { echo >&2 "Error copying run_causal.py"; exit 3; }
+cp $DATADIR/causal/token_cache.py $DATADIR/causal/extraction_utils.py $DATADIR/causal/causal_store.py $DATADIR/causal/online_stats.py $SCRATCHDIR || { echo >&2 "Error copying helper modules"; exit 3; }
 
 cd $SCRATCHDIR
 
@@ -39,33 +40,27 @@ JSON_PATH="$SCRATCHDIR/causal_prompts/$LANG_FILE"
 # # Copy all CSV results back
 # cp *.csv $DATADIR/causal/ || { echo >&2 "Result file(s) copying failed (exit code $?)"; exit 4; }
 
-# Determine number of entries in JSON
-NUM_ENTRIES=$($PYTHON_EXE - <<EOF
-import pandas as pd
-df = pd.read_json("$JSON_PATH")
-print(len(df))
-EOF
-)
-if [ -z "$NUM_ENTRIES" ]; then
-    echo "Failed to read number of entries" >&2
-    exit 6
-fi
-
-echo "=== Causal tracing: processing $NUM_ENTRIES entries ==="
-
-for (( idx=0; idx<NUM_ENTRIES; idx++ )); do
-    echo "Processing entry $idx out of $NUM_ENTRIES"
-    $PYTHON_EXE run_causal.py \
-        --hf_token $HF_TOKEN \
-        --json_file "$JSON_PATH" \
-        --m_noise 5 \
-        --window 3 \
-        --entry_idx $idx || { echo >&2 "run_causal.py failed on entry $idx"; exit 7; }
-
-    # Copy CSV immediately
-    PID=$(ls *.csv | tail -n 1)
-    cp "$PID" $DATADIR/causal/ || { echo >&2 "Failed copying $PID"; exit 8; }
-    rm "$PID"
-done
+# One long-lived worker: the model is loaded once and entries are claimed from a
+# work queue on shared storage, so several jobs can be submitted against the same
+# queue. Four prompts are claimed and traced together in one padded batch; their
+# CSVs are written to $DATADIR/causal as soon as the batch finishes. Finished
+# (seed, stream) blocks are checkpointed. Every claim records its job, host and pid;
+# claims older than the walltime (--claim_timeout, in seconds) or of a dead process on
+# the worker's host are put back by the next worker and resume where they stopped.
+QUEUE_DIR=$DATADIR/causal/queue_${LANG_FILE%.json}
+
+echo "=== Causal tracing: worker on queue $QUEUE_DIR ==="
+
+$PYTHON_EXE run_causal.py \
+    --hf_token $HF_TOKEN \
+    --json_file "$JSON_PATH" \
+    --m_noise 5 \
+    --window 3 \
+    --queue_dir "$QUEUE_DIR" \
+    --claim_timeout 1800 \
+    --prompts_per_batch 4 \
+    --checkpoint \
+    --prefix_cache \
+    --out_dir $DATADIR/causal || { echo >&2 "run_causal.py worker failed (exit code $?)"; exit 7; }
 
 clean_scratch
@@ -16,6 +16,10 @@ test -n "$SCRATCHDIR" || { echo >&2 "Variable SCRATCHDIR is not set!"; exit 1; }
 cp -r $DATADIR/all_sentences_train.csv $SCRATCHDIR || { echo >&2 "Error while copying JSON input!"; exit 2; }
 cp -r $DATADIR/all_sentences_test.csv $SCRATCHDIR || { echo >&2 "Error while copying JSON input!"; exit 2; }
 cp $DATADIR/sae/run_model.py $SCRATCHDIR || { echo >&2 "Error copying run_model.py"; exit 3; }
+cp $DATADIR/sae/activation_store.py $SCRATCHDIR || { echo >&2 "Error copying activation_store.py"; exit 3; }
+cp $DATADIR/sae/extraction_utils.py $SCRATCHDIR || { echo >&2 "Error copying extraction_utils.py"; exit 3; }
+cp $DATADIR/sae/token_cache.py $SCRATCHDIR || { echo >&2 "Error copying token_cache.py"; exit 3; }
+cp $DATADIR/sae/online_stats.py $SCRATCHDIR || { echo >&2 "Error copying online_stats.py"; exit 3; }
 
 cd $SCRATCHDIR
 
@@ -39,7 +43,8 @@ for LAYER in $LAYERS; do
     --torch-dtype float16 \
     --batch-size 16 \
     --model-name  meta-llama/Llama-3.1-8B \
-    --layer-idx   $LAYER \
+    --layers      $LAYER \
+    --cache-dir   $DATADIR/sae/extraction_cache \
     --out-dir     ./model_outputs
 done
 
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+One-time tokenization stage shared by extraction, causal tracing and steering.
+
+Sentence CSVs (all_sentences_{train,test}.csv, the temporal corpus) are
+tokenized word-aligned, exactly like the extraction scripts do
+(`is_split_into_words=True`); prompt JSONs (causal `prompt`, cloze
+`prompt_text`) are tokenized as plain text. For every source the cache stores
+
+    {cache_dir}/{tokenizer_hash}/{name}/input_ids.npy   # int32, all rows concatenated
+    {cache_dir}/{tokenizer_hash}/{name}/word_ids.npy    # int32, word index per token (-1 = special)
+    {cache_dir}/{tokenizer_hash}/{name}/offsets.npy     # int64, row i is [offsets[i], offsets[i+1])
+    {cache_dir}/{tokenizer_hash}/{name}/texts.json      # row texts, used to look rows up
+
+so downstream scripts only pad cached ids instead of calling the tokenizer.
+
+Usage:
+    python3 token_cache.py --hf-token $HF_TOKEN --cache-dir ./token_cache \
+        --csv all_sentences_train.csv all_sentences_test.csv \
+        --json causal_prompts/translated_prompts_fr.json prompts_dataset_test.json
+"""
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+
+from extraction_utils import token_budget_batches
+
+PROMPT_FIELDS = ('prompt', 'prompt_text')
+
+
+def tokenizer_hash(tokenizer):
+    # padding/truncation are per-call settings of the backend, not part of the vocabulary
+    config = json.loads(tokenizer.backend_tokenizer.to_str())
+    config.pop('padding', None)
+    config.pop('truncation', None)
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def cache_path(cache_dir, tokenizer, name):
+    return os.path.join(cache_dir, tokenizer_hash(tokenizer), name)
+
+
+def build_cache(texts, tokenizer, out_dir, split_into_words):
+    texts = list(dict.fromkeys(texts))
+    inputs = [t.split() for t in texts] if split_into_words else texts
+    enc = tokenizer(inputs, is_split_into_words=split_into_words)
+    input_ids, word_ids, offsets = [], [], [0]
+    for i, ids in enumerate(enc['input_ids']):
+        input_ids.extend(ids)
+        word_ids.extend(-1 if w is None else w for w in enc.word_ids(i))
+        offsets.append(offsets[-1] + len(ids))
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, 'input_ids.npy'), np.asarray(input_ids, dtype=np.int32))
+    np.save(os.path.join(out_dir, 'word_ids.npy'), np.asarray(word_ids, dtype=np.int32))
+    np.save(os.path.join(out_dir, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+    with open(os.path.join(out_dir, 'texts.json'), 'w', encoding='utf-8') as f:
+        json.dump({'split_into_words': split_into_words, 'texts': texts}, f, ensure_ascii=False)
+    return len(texts), len(input_ids)
+
+
+def read_texts(path):
+    if path.endswith('.json'):
+        df = pd.read_json(path)
+        field = next((f for f in PROMPT_FIELDS if f in df.columns), None)
+        if field is None:
+            raise KeyError(f"{path} has none of the prompt fields {PROMPT_FIELDS}")
+        return df[field].tolist(), False
+    df = pd.read_csv(path, encoding='utf-8-sig')
+    return df['sentence'].tolist(), True
+
+
+class CachedBatch(dict):
+    """Padded batch built from cached ids; mirrors the parts of BatchEncoding the scripts use."""
+
+    def __init__(self, data, word_id_rows):
+        super().__init__(data)
+        self.word_id_rows = word_id_rows
+
+    def word_ids(self, batch_index=0):
+        return self.word_id_rows[batch_index]
+
+    def to(self, device):
+        return CachedBatch({k: v.to(device) for k, v in self.items()}, self.word_id_rows)
+
+
+class TokenCache:
+    def __init__(self, cache_dir, tokenizer, name):
+        self.path = cache_path(cache_dir, tokenizer, name)
+        if not os.path.isdir(self.path):
+            raise FileNotFoundError(
+                f"No token cache for '{name}' and this tokenizer at {self.path}; run token_cache.py first"
+            )
+        self.input_ids_flat = np.load(os.path.join(self.path, 'input_ids.npy'), mmap_mode='r')
+        self.word_ids_flat = np.load(os.path.join(self.path, 'word_ids.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(self.path, 'offsets.npy'))
+        with open(os.path.join(self.path, 'texts.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        self.split_into_words = meta['split_into_words']
+        self.row_of = {text: i for i, text in enumerate(meta['texts'])}
+        self.lengths = np.diff(self.offsets)
+        self.pad_token_id = tokenizer.pad_token_id
+        self.padding_side = tokenizer.padding_side
+
+    def rows(self, texts):
+        missing = [t for t in texts if t not in self.row_of]
+        if missing:
+            raise KeyError(f"{len(missing)} texts are not in the token cache {self.path}, "
+                           f"e.g. {missing[0]!r}; rebuild it with token_cache.py")
+        return [self.row_of[t] for t in texts]
+
+    def input_ids(self, row):
+        return np.asarray(self.input_ids_flat[self.offsets[row]:self.offsets[row + 1]], dtype=np.int64)
+
+    def word_ids(self, row):
+        return [None if w < 0 else int(w)
+                for w in self.word_ids_flat[self.offsets[row]:self.offsets[row + 1]]]
+
+    def batch(self, rows):
+        width = int(max(self.lengths[r] for r in rows))
+        input_ids = torch.full((len(rows), width), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), width), dtype=torch.long)
+        word_id_rows = []
+        for i, r in enumerate(rows):
+            ids, n = self.input_ids(r), int(self.lengths[r])
+            span = slice(width - n, width) if self.padding_side == 'left' else slice(0, n)
+            input_ids[i, span] = torch.from_numpy(ids)
+            attention_mask[i, span] = 1
+            pad = [None] * (width - n)
+            words = self.word_ids(r)
+            word_id_rows.append(pad + words if self.padding_side == 'left' else words + pad)
+        return CachedBatch({'input_ids': input_ids, 'attention_mask': attention_mask}, word_id_rows)
+
+    def iter_batches(self, rows, max_tokens=None, max_batch_size=None):
+        """Cached counterpart of extraction_utils.iter_token_batches over cache `rows`."""
+        lengths = [int(self.lengths[r]) for r in rows]
+        for indices in token_budget_batches(lengths, max_tokens, max_batch_size):
+            yield indices, self.batch([rows[i] for i in indices])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pre-tokenize sentence CSVs and prompt JSONs")
+    parser.add_argument('--model-name', type=str, default='meta-llama/Llama-3.1-8B')
+    parser.add_argument('--hf-token', type=str, default=None)
+    parser.add_argument('--cache-dir', type=str, default='./token_cache')
+    parser.add_argument('--csv', type=str, nargs='*', default=[],
+                        help="Sentence CSVs with a 'sentence' column (word-aligned tokenization)")
+    parser.add_argument('--json', type=str, nargs='*', default=[],
+                        help="Prompt JSONs with a 'prompt' or 'prompt_text' field")
+    return parser.parse_args()
+
+
+def main():
+    from transformers import AutoTokenizer
+    args = parse_args()
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name, use_fast=True, token=args.hf_token)
+    for path in args.csv + args.json:
+        texts, split_into_words = read_texts(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        out_dir = cache_path(args.cache_dir, tokenizer, name)
+        n_rows, n_tokens = build_cache(texts, tokenizer, out_dir, split_into_words)
+        print(f"Saved {out_dir}: {n_rows} rows, {n_tokens} tokens")
+
+
+if __name__ == '__main__':
+    main()